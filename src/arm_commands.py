@@ -7,23 +7,42 @@ the servo motors, they are doing higher level operations which consists of serie
 
 import os
 import json
+import queue
+import functools
 import requests
 import websocket
 import concurrent.futures
 from datetime import datetime
 from pathlib import Path
 from yaml import load, Loader, YAMLError
-from time import sleep, time
+from time import sleep, time, monotonic
 
 from camera import Camera
-from storage import Storage
+from framing import send_frame
+from job_scheduler import JobScheduler
+from storage import Storage, UPLOAD_BYTES, UPLOAD_SECONDS, STORAGE_BYTES
+from upload_batcher import UploadBatcher
 from magnet import MagnetControl
-from servo_control import ServoControl
+from pick_verifier import PickVerifier
+from servo_control import ServoControl, interpolate_position
+from session_map import SessionMap
 from logger import Logger
+from metrics import REGISTRY
+from profiler import SamplingProfiler
+from replay import SessionRecorder, RecordingCamera
+from executors import ExecutorRegistry
+
+
+CLOUD_CONNECT_SECONDS = REGISTRY.histogram("cloud_connect_seconds", "Duration of the WebSocket handshakes with the Cloud service.")
+CLOUD_RESPONSE_SECONDS = REGISTRY.histogram(
+    "cloud_response_seconds", "Time from sending a message to the Cloud service until its answer arrives."
+)
+SESSION_SECONDS = REGISTRY.histogram("session_seconds", "Duration of the sessions and training recordings.", (10, 30, 60, 120, 300, 600))
+JOB_QUEUE_DEPTH = REGISTRY.gauge("job_queue_depth", "Number of pending jobs in the queues of the arm.")
 
 
 class ArmCommands:
-    def __init__(self, config_path):
+    def __init__(self, config_path, arm=None, backends=None, root=None):
         """
         Contains all the higher level commands used to control the robotic arm.
 
@@ -31,18 +50,17 @@ class ArmCommands:
         ----------
         config_path : str
             Path to the config file.
+        arm : dict
+            Optional settings of a single arm overriding the values of the config file, used when multiple arms are driven from
+            one process. Can include arm_id, servo_pins, start_positions, magnet_pin and camera_num.
+        backends : dict
+            Optional hardware backends with the keys "pi", "camera" and "gpio", which are used instead of pigpio, PiCamera and RPi.GPIO.
+            Used to run the arm on simulated hardware.
+        root : str
+            Optional folder where the sessions, recordings, storage index and pending jobs are saved, instead of the root of the project.
 
         """
 
-        self.camera = Camera()
-        self.storage = Storage()
-        self.sc = ServoControl()
-        self.magnet = MagnetControl()
-        self.cloud_websocket = None
-        self.logger = Logger(config_path).logger
-
-        self.current_set_path = self.storage.create_next_train_folder()
-
         # Parse config.yaml
         with open(config_path, 'r') as stream:
             try:
@@ -50,10 +68,208 @@ class ArmCommands:
             except YAMLError as error:
                 print("Error while opening config.yaml ", error)
 
+        config = {**config, **(arm or {})}
+        backends = backends or {}
+
+        servo_args = {}
+        if "servo_pins" in config:
+            servo_args["servos"] = tuple(config["servo_pins"])
+        if "start_positions" in config:
+            servo_args["start_positions"] = tuple(config["start_positions"])
+        if "servo_deadband" in config:
+            servo_args["deadband"] = config["servo_deadband"]
+        if "motion_profile" in config:
+            servo_args["profile"] = config["motion_profile"]
+        if "servo_limits" in config:
+            servo_args["limits"] = config["servo_limits"]
+
+        self.camera = Camera(camera_num=config.get("camera_num", 0), camera=backends.get("camera"))
+        # Arms of a fleet save their files in separate folders, so their sessions cannot overwrite each other's images
+        self.storage = Storage(
+            subfolder=config["arm_id"] if arm else "",
+            quota_mb=config.get("storage_quota_mb"),
+            max_age_days=config.get("storage_max_age_days"),
+            evict_unuploaded=config.get("storage_evict_unuploaded", False),
+            root=root
+        )
+        self.storage.enforce_retention()
+        self.sc = ServoControl(pi=backends.get("pi"), **servo_args)
+        # Motion needs a thread for each servo and one for the background movement waiting for them, see ServoControl
+        self.executors = ExecutorRegistry(
+            {"motion": len(self.sc.servos) + 1, "uploads": config.get("upload_workers", 5)}, owner=config["arm_id"]
+        )
+        self.sc.executor = self.executors.get("motion")
+        self.magnet = MagnetControl(
+            pin=config.get("magnet_pin", 23),
+            gpio=backends.get("gpio"),
+            rise_dwell=config.get("magnet_rise_dwell", 0.0),
+            release_dwell=config.get("magnet_release_dwell", 0.0),
+            pre_energize=config.get("magnet_pre_energize", 1.0),
+            early_release=config.get("magnet_early_release", 1.0)
+        )
+        self.cloud_websocket = None
+        self.session_map = None
+        # Positions of servo 0 at the exposure of the images taken while sweeping, keyed by path
+        self.image_angles = {}
+        self.logger = Logger(config_path).logger
+
+        self.current_set_path = self.storage.create_next_train_folder()
+
         self.config = config
         self.cloud_url = f"http://{config['cloud_host']}:{config['cloud_port']}/"
         self.ws_cloud_url = f"ws://{config['cloud_host']}:{config['cloud_port']}"
         self.control_url = f"http://{config['control_host']}:{config['control_port']}/"
+        self.pick_verifier = PickVerifier(config.get("verify_threshold", 12)) if config.get("pick_verification", False) else None
+        self.upload_batcher = UploadBatcher(config.get("max_batch_size", 5)) if config.get("batched_upload", False) else None
+        # Inputs of the current session, if record_sessions is enabled
+        self.recorder = None
+        self.last_recording = None
+        # Profiler of the running job, if profiling is enabled
+        self.profiler = None
+        # Can be toggled by the Control Panel, takes effect from the next job
+        self.profiling = config.get("profile_sessions", False)
+
+        # Sessions and recordings are executed one by one by the arm worker, uploads run in the background
+        jobs_path = os.path.join(self.storage.root, f"jobs{'_' + config['arm_id'] if arm else ''}.json")
+        self.scheduler = JobScheduler(
+            jobs_path, throttled_rate=config.get("throttled_upload_rate", 200000), logger=self.logger, arm_id=config["arm_id"]
+        )
+        self.scheduler.register(
+            "sort", self.profiled(self.recorded(self.infer_and_sort), lambda: self.curr_sess_path), priority=0, uses_arm=True
+        )
+        self.scheduler.register("record", self.profiled(self.record_training_video, lambda: self.current_set_path), priority=1, uses_arm=True)
+        self.scheduler.register(
+            "upload",
+            lambda bucket, path: self.storage.upload_file(bucket, path, callback=self.scheduler.throttle),
+            priority=3,
+            persistent=True
+        )
+        self.scheduler.register("upload_after", self.upload_after_image, priority=3, persistent=True)
+        self.scheduler.register("stitch", self.request_stitching, priority=4, persistent=True)
+        self.scheduler.start()
+        for lane in self.scheduler.queues:
+            JOB_QUEUE_DEPTH.track(lambda lane=lane: self.scheduler.stats()["queue_depth"][lane], arm_id=config["arm_id"], lane=lane)
+
+    def profiled(self, function, get_folder):
+        """
+        Wraps a job, so its threads are sampled by the profiler while it runs, if profiling is enabled. The sampled stacks are
+        written to profile.folded in the folder of the job, which is tracked as an uploaded artifact, so retention can delete it.
+
+        Parameters
+        ----------
+        function : function
+            The job to be wrapped.
+        get_folder : function
+            Returns the folder where the profile should be written, called after the job is finished, unless the job saved
+            its profile itself.
+
+        Returns
+        -------
+        job : function
+            The wrapped job.
+
+        """
+
+        @functools.wraps(function)
+        def job(*args):
+            if not self.profiling:
+                return function(*args)
+
+            self.profiler = SamplingProfiler(self.config.get("profiler_interval", 0.01))
+            self.profiler.start()
+            try:
+                return function(*args)
+            finally:
+                # Finished sessions save their profile themselves, this saves the ones which failed and the other jobs
+                self.save_profile(get_folder(), function.__name__)
+
+        return job
+
+    def save_profile(self, folder, name):
+        """
+        Stops the profiler of the running job, if it is profiled, writes the sampled stacks to profile.folded in the given folder
+        and tracks it as an uploaded artifact. Sessions have to call it before they are finished, for the same reason as save_recording.
+
+        Parameters
+        ----------
+        folder : str
+            Folder where the profile is written.
+        name : str
+            Name of the profiled job, used in the log.
+
+        """
+
+        if not self.profiler:
+            return
+
+        profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        profile_path = os.path.join(folder, "profile.folded")
+        os.makedirs(folder, exist_ok=True)
+        profiler.write(profile_path)
+        self.storage.track(profile_path, uploaded=True)
+        log_args = {"arm_id": self.config["arm_id"], "session_id": getattr(self, "session_id", None), "log_type": "comm_gen"}
+        self.logger.info(f"Profile of {name} saved to {profile_path}: {json.dumps(profiler.summary())}", log_args)
+
+    def recorded(self, function):
+        """
+        Wraps a sort session, so everything it receives from outside is recorded to session.zip in the session folder, if record_sessions
+        is enabled. The archive is tracked as an uploaded artifact, so retention can delete it. See replay.py for replaying it.
+
+        Parameters
+        ----------
+        function : function
+            The session to be wrapped.
+
+        Returns
+        -------
+        job : function
+            The wrapped session.
+
+        """
+
+        @functools.wraps(function)
+        def job(*args):
+            if not self.config.get("record_sessions", False):
+                return function(*args)
+
+            self.recorder = SessionRecorder()
+            camera = self.camera.camera
+            self.camera.camera = RecordingCamera(camera, self.recorder)
+            try:
+                return function(*args)
+            finally:
+                self.camera.camera = camera
+                # Finished sessions save their recording themselves, this saves the ones which failed
+                self.save_recording()
+
+        return job
+
+    def save_recording(self):
+        """
+        Saves the recording of the current session to session.zip in the session folder, if the session is recorded, and tracks it
+        as an uploaded artifact. Has to be called before the session is finished, since finishing deletes the session folder
+        if no image is left in it, and retention has to see the archive.
+
+        """
+
+        if not self.recorder:
+            return
+
+        self.last_recording = os.path.join(self.curr_sess_path, "session.zip")
+        os.makedirs(self.curr_sess_path, exist_ok=True)
+        self.recorder.save(self.last_recording, self.config)
+        self.storage.track(self.last_recording, uploaded=True)
+        self.recorder = None
+
+    def mark(self, phase):
+        """
+        Marks the end of a phase of the session, if it is recorded.
+
+        """
+
+        if self.recorder:
+            self.recorder.mark(phase)
 
     def record_training_video(self):
         """
@@ -62,25 +278,30 @@ class ArmCommands:
 
         """
 
+        started = time()
         video_path = os.path.join(self.current_set_path, datetime.now().strftime("%d.%m.%Y_%H:%M:%S") + ".h264")
         self.camera.start(path=video_path)
         self.sc.execute_commands(((0, 800, "dataset"),))
         self.camera.stop()
+        self.storage.track(video_path)
 
         # Don't wait for upload to finish before initializing the arm
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
-        executor.submit(self.storage.upload_file, "sorterbot-training-videos", video_path)
-        executor.submit(self.sc.init_arm_position)
+        self.scheduler.submit("upload", "sorterbot-training-videos", video_path)
+        self.sc.init_arm_position()
+        SESSION_SECONDS.observe(time() - started, arm_id=self.config["arm_id"], kind="record")
 
     def infer_and_sort(self):
         """
         Controls the process of localizing objects and moving them to the containers on the Raspberry side.
         First it takes images for inference, sends them for processing, and after all of them were successfully processed,
         requests the session's commands from the cloud service. After the commands are received, executes them one by one
-        and returns the arm to the initial position.
+        and returns the arm to the initial position. If incremental_commands is enabled in the config file, the commands are
+        generated locally from the per-image detections instead, and execution starts as soon as an area of the scan is final.
 
         """
 
+        started = time()
+
         # Construct session path
         self.curr_sess_path = self.storage.create_next_session_folder()
 
@@ -95,66 +316,238 @@ class ArmCommands:
             "status": "In Progress",
             "log_filenames": ",".join(reversed([str(step) for step in steps]))
         })
+        if self.recorder:
+            self.recorder.add_control_reply("create_session", response.json())
         res_json = json.loads(response.json())
         self.session_id = res_json["new_session_id"]
+        self.mark("session_created")
 
-        # Take pictures and send them for processing
-        all_success = self.take_pictures(steps)
         log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_exec"}
+        self.logger.info(f"Session started, job queues: {json.dumps(self.scheduler.stats())}, pools: {json.dumps(self.executors.stats())}", log_args)
 
-        # If all successful, send a request to process session images and generate commands
-        if all_success:
-            self.logger.info("All images successfully processed, requesting commands...", dict(bm_id=8, **log_args))
-            cloud_websocket = websocket.create_connection(self.ws_cloud_url)
-            cloud_websocket.send(json.dumps({
-                "command": "get_commands_of_session",
-                "session_id": self.session_id,
-                "arm_constants": self.config
-            }))
-            commands_as_pw = cloud_websocket.recv()
-            commands_as_pw = json.loads(commands_as_pw)
-            self.logger.info("Commands received.", dict(bm_id=17, **log_args))
-            cloud_websocket.close()
-
-            if len(commands_as_pw) == 0:
-                self.logger.warning("No containers were found, moving to initial position.", log_args)
+        # Take pictures and send them for processing
+        if self.config.get("incremental_commands", False):
+            # Commands are generated locally from the per-image results, so sorting starts as soon as an area is final
+            self.session_map = SessionMap(
+                steps,
+                fov_as_pw=self.config.get("image_fov_as_pw", 670),
+                tolerance_as_pw=self.config.get("duplicate_tolerance_as_pw", 60),
+                result_timeout=self.config.get("result_timeout", 120)
+            )
+            upload_futures = self.capture_images(steps, self.executors.get("uploads"))
+            for step, future in zip(steps, upload_futures):
+                future.add_done_callback(self.release_failed_upload(step))
+            all_success = True
+            commands_as_pw = self.session_map.iter_commands()
         else:
-            commands_as_pw = []
-            self.logger.error("At least one image failed processing, moving to initial position.", log_args)
+            upload_futures = None
+            all_success = self.take_pictures(steps)
+
+            # If all successful, send a request to process session images and generate commands
+            if all_success:
+                self.logger.info("All images successfully processed, requesting commands...", dict(bm_id=8, **log_args))
+                commands_as_pw = self.request_commands()
+            else:
+                commands_as_pw = []
+                self.logger.error("At least one image failed processing, moving to initial position.", log_args)
+
+        self.mark("scanned")
+
+        # While the Cloud service is generating the commands, move the arm to a staging pose above the center of the scanned area,
+        # so the first pickup starts closer to its destination
+        staging = None
+        if all_success and self.config.get("preposition_arm", False):
+            staging = self.executors.get("motion").submit(
+                self.sc.move_to_staging_position,
+                sum(steps) / len(steps),
+                (self.config["dist_min_as_pw"] + self.config["dist_max_as_pw"]) / 2
+            )
 
         # Instruct arm to move each object to the appropriate containers
+        n_commands = 0
         for cmd in commands_as_pw:
-            self.sc.move_to_position(cmd[0])
-            self.logger.info(f"Arm moved to object at position ({int(cmd[0][0])}, {int(cmd[0][1])}) for pick up.", log_args)
-            self.magnet.on()
-            self.logger.info(f"Magnet ON.", log_args)
-            self.sc.move_to_position(cmd[1], is_container=True)
+            if n_commands == 0:
+                self.logger.info("Commands received.", dict(bm_id=17, **log_args))
+                self.mark("first_command")
+                # Servo positions are not thread safe, so staging has to be finished before the first command
+                if staging:
+                    staging.result()
+            # Stopping the scheduler aborts the session between two objects
+            self.scheduler.check_cancelled()
+            n_commands += 1
+
+            self.magnet.start_cycle()
+            if not self.pick_object(cmd[0], log_args):
+                self.logger.warning(f"Object at position ({int(cmd[0][0])}, {int(cmd[0][1])}) could not be picked up, skipping it.", log_args)
+                continue
+            self.sc.move_to_position(cmd[1], is_container=True, trigger=self.magnet.release_trigger())
             self.logger.info(f"Arm moved to container at position ({int(cmd[1][0])}, {int(cmd[1][1])}) for drop off.", log_args)
-            self.magnet.off()
-            self.logger.info(f"Magnet OFF.", log_args)
+            self.magnet.settle_release()
+            self.logger.info(f"Magnet OFF, cycle times: {json.dumps(self.magnet.cycle_times())}", log_args)
+
+        if staging:
+            staging.result()
+
+        if upload_futures:
+            concurrent.futures.wait(upload_futures)
+            if self.session_map.failed:
+                self.logger.error(f"Processing failed for the following images: {self.session_map.failed}", log_args)
+            self.session_map = None
+
+        if all_success and n_commands == 0:
+            self.logger.warning("No containers were found, moving to initial position.", log_args)
 
         self.logger.info("Commands executed.", dict(bm_id=18, **log_args))
+        self.mark("commands_executed")
+
+        # Reset arm to initial position, taking the after images on the way if enabled. They are uploaded and stitched in the background
+        self.reset_arm(after_image_steps=steps if self.config.get("after_images", False) else None)
+        self.logger.info(f"Arm reset to initial position, session finished.", dict(session_finished=1, bm_id=25, **log_args))
+        self.mark("reset")
+        self.logger.info(f"Servo command stats: {json.dumps(self.sc.stats())}", log_args)
+        SESSION_SECONDS.observe(time() - started, arm_id=self.arm_id, kind="sort")
+
+        self.save_profile(self.curr_sess_path, "infer_and_sort")
+        self.save_recording()
+        self.storage.finish_session(self.curr_sess_path)
+        evicted = self.storage.enforce_retention()
+        if evicted:
+            self.logger.info(f"Storage retention deleted {len(evicted)} artifacts.", log_args)
+
+    def pick_object(self, obj_pos, log_args):
+        """
+        Moves the arm to the object and turns on the magnet. If pick verification is enabled, a low resolution frame is taken above
+        the object before and after the pick. If the area of the object did not change, the pick failed, and it is retried
+        up to verify_retries times.
 
-        if False:
-            # Take pictures and send them for after picture
-            all_success = self.take_pictures(steps, is_after=True)
+        Parameters
+        ----------
+        obj_pos : tuple
+            Polar coordinates of the object.
+        log_args : dict
+            Arguments of the logs of the session.
 
-            self.logger.info("All after pictures taken and uploads started.", dict(bm_id=15, **log_args))
+        Returns
+        -------
+        picked : bool
+            Boolean representing if the object was picked up. Always true if pick verification is disabled.
 
-            # Start stitching of after image
-            cloud_websocket = websocket.create_connection(self.ws_cloud_url)
-            cloud_websocket.send(json.dumps({
-                "command": "stitch_after_image",
-                "arm_id": self.config["arm_id"],
-                "session_id": self.session_id
-            }))
+        """
+
+        self.sc.move_above_position(obj_pos)
+        hover_positions = list(self.sc.curr_positions)
+        reference = self.camera.capture_frame() if self.pick_verifier else None
+
+        for attempt in range(1 + self.config.get("verify_retries", 1)):
+            self.sc.descend_to_position(obj_pos, trigger=self.magnet.pick_trigger())
+            self.logger.info(f"Arm moved to object at position ({int(obj_pos[0])}, {int(obj_pos[1])}) for pick up.", log_args)
+            self.magnet.settle_pick()
+            self.logger.info(f"Magnet ON.", log_args)
+
+            if not self.pick_verifier:
+                return True
+
+            self.sc.lift_to(hover_positions)
+            picked, difference = self.pick_verifier.verify(reference, self.camera.capture_frame())
+            self.logger.info(f"Pick verification attempt {attempt + 1}: difference {difference:.1f}, picked: {picked}.", log_args)
+            if picked:
+                return True
+
+            self.magnet.off()
+
+        return False
+
+    def request_commands(self):
+        """
+        Requests the commands of the current session from the Cloud service. If stream_commands is enabled in the config file,
+        the Cloud service is asked to send the commands one per message, so execution can begin before the full list is generated.
+        Servers that do not support streaming reply with the full list in a single message, which is handled transparently.
+
+        Returns
+        -------
+        commands : generator
+            Generator yielding the commands as they arrive. Each command is a tuple of the object's and the container's polar coordinates.
+
+        """
+
+        cloud_websocket = websocket.create_connection(self.ws_cloud_url)
+        cloud_websocket.send(json.dumps({
+            "command": "get_commands_of_session",
+            "session_id": self.session_id,
+            "arm_constants": self.config,
+            "stream": self.config.get("stream_commands", False)
+        }))
+
+        return self.receive_commands(cloud_websocket, time())
+
+    def receive_commands(self, cloud_websocket, requested_at=None):
+        """
+        Receives commands from an open WebSocket connection until the session's commands are exhausted, then closes the connection.
+        A streamed command arrives as {"command": [obj_pos, cont_pos]} and the end of the stream is marked with {"done": true}.
+
+        Parameters
+        ----------
+        cloud_websocket : websocket.WebSocket
+            Connection on which the commands were requested.
+        requested_at : float
+            Timestamp of the request, used to record the arrival times of the commands.
+
+        Yields
+        ------
+        command : list
+            List containing the object's and the container's polar coordinates.
+
+        """
+
+        try:
+            while True:
+                message = json.loads(cloud_websocket.recv())
+                offset = time() - (requested_at or time())
+
+                # Non-streaming reply containing every command of the session
+                if isinstance(message, list):
+                    for command in message:
+                        if self.recorder:
+                            self.recorder.add_command(command, offset)
+                        yield command
+                    break
+
+                if message.get("done"):
+                    break
+
+                if self.recorder:
+                    self.recorder.add_command(message["command"], offset)
+                yield message["command"]
+
+            if self.recorder:
+                self.recorder.commands_done(offset)
+        finally:
             cloud_websocket.close()
 
-            self.logger.info("Stitching after images started.", dict(bm_id=16, **log_args))
+    def release_failed_upload(self, step):
+        """
+        Creates a callback for the upload future of an image in incremental mode. If the upload raised an exception, the image is
+        registered as failed, otherwise the session would wait for its result forever.
+
+        Parameters
+        ----------
+        step : int
+            Identifies the image, corresponds to the pulse width of servo 0 where the image was taken.
 
-        # Reset arm to initial position
-        self.reset_arm()
-        self.logger.info(f"Arm reset to initial position, session finished.", dict(session_finished=1, bm_id=25, **log_args))
+        Returns
+        -------
+        callback : function
+            Function to be added as done callback to the future.
+
+        """
+
+        session_map = self.session_map
+
+        def callback(future):
+            if future.exception():
+                session_map.add_result(step, False)
+
+        return callback
 
     def take_pictures(self, steps, is_after=False):
         """
@@ -177,33 +570,7 @@ class ArmCommands:
 
         """
 
-        # Init arm position for inference
-        self.sc.init_arm_position(is_inference=True)
-
-        # Execute sequence
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
-            futures = []
-            for step in steps:
-                log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": step}
-
-                # Construct image path
-                image_path = Path(self.curr_sess_path).joinpath(f"{step}.jpg")
-
-                # Move arm to next position
-                self.sc.execute_commands([(0, step)])
-                self.logger.info(f"Arm is in position for picture '{step}'.", log_args)
-
-                # Wait a bit for stabilization (and upload previous results in the meantime)
-                sleep(0.75)
-                self.logger.info(f"Arm is stabilized.", log_args)
-
-                # Take the picture
-                self.camera.take_picture(image_path.as_posix())
-                self.logger.info(f"Picture '{step}' taken.", dict(bm_id=1, **log_args))
-
-                # Send picture directly to Cloud service
-                future = executor.submit(self.send_image_for_processing, image_path, step, is_after)
-                futures.append(future)
+        futures = self.capture_images(steps, self.executors.get("uploads"), is_after)
 
         results = []
         for future in concurrent.futures.as_completed(futures):
@@ -213,7 +580,8 @@ class ArmCommands:
                 "success": success
             })
 
-        self.logger.info("All images successfully processed.", {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_gen"})
+        log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_gen"}
+        self.logger.info("All images successfully processed.", log_args)
 
         # Check if all of the pictures were processed successfully
         all_success = all([res["success"] for res in results])
@@ -224,7 +592,200 @@ class ArmCommands:
 
         return all_success
 
-    def send_image_for_processing(self, image_path, step, is_after):
+    def capture_images(self, steps, executor, is_after=False):
+        """
+        Moves the arm through the scanning positions and takes a picture at each of them. Every picture is submitted to the executor
+        to be sent for processing right after it was taken, so uploads overlap with the movement of the arm.
+
+        Parameters
+        ----------
+        steps : list of ints
+            List containing pulse widths of servo 0 where images should be taken.
+        executor : concurrent.futures.Executor
+            Executor used to send the images to the Cloud service.
+        is_after : bool
+            Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
+            been moved to the containers.
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            Futures of the uploads, each resolving to a tuple of (success, step).
+
+        """
+
+        self.image_angles = {}
+        if self.config.get("sweep_scan", False):
+            return self.sweep_images(steps, executor, is_after)
+
+        # Init arm position for inference
+        self.sc.init_arm_position(is_inference=True)
+
+        # Execute sequence
+        futures = []
+        batch = []
+        for step in steps:
+            self.scheduler.check_cancelled()
+            log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": step}
+
+            # Construct image path
+            image_path = Path(self.curr_sess_path).joinpath(f"{step}.jpg")
+
+            # Move arm to next position
+            self.sc.execute_commands([(0, step)])
+            self.logger.info(f"Arm is in position for picture '{step}'.", log_args)
+
+            # Wait a bit for stabilization (and upload previous results in the meantime)
+            sleep(0.75)
+            self.logger.info(f"Arm is stabilized.", log_args)
+
+            # Take the picture
+            self.camera.take_picture(image_path.as_posix())
+            self.logger.info(f"Picture '{step}' taken.", dict(bm_id=1, **log_args))
+
+            # Send picture directly to Cloud service, or collect it into the next batch
+            if self.upload_batcher:
+                batch.append((image_path, step))
+                if len(batch) >= self.upload_batcher.batch_size() or step == steps[-1]:
+                    futures.extend(self.submit_batch(executor, batch, is_after))
+                    batch = []
+            else:
+                future = executor.submit(self.send_image_for_processing, image_path, step, is_after)
+                futures.append(future)
+
+        return futures
+
+    def sweep_images(self, steps, executor, is_after=False):
+        """
+        Takes the pictures for inference while sweeping through the scanning positions, see sweep_captures. Since the capture does not
+        happen exactly at the step, every image is tagged with the position of servo 0 interpolated at the time of the exposure,
+        which is sent to the Cloud service as the image_angle header.
+
+        Parameters
+        ----------
+        steps : list of ints
+            List containing pulse widths of servo 0 where images should be taken.
+        executor : concurrent.futures.Executor
+            Executor used to send the images to the Cloud service.
+        is_after : bool
+            Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
+            been moved to the containers.
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            Futures of the uploads, each resolving to a tuple of (success, step).
+
+        """
+
+        log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_gen"}
+
+        futures = []
+        batch = []
+        for step, image_path in self.sweep_captures(steps, self.curr_sess_path):
+            self.logger.info(f"Picture '{step}' taken at {self.image_angles[image_path.as_posix()]:.1f}.", dict(bm_id=1, **log_args))
+
+            if self.upload_batcher:
+                batch.append((image_path, step))
+                if len(batch) >= self.upload_batcher.batch_size() or len(futures) + len(batch) == len(steps):
+                    futures.extend(self.submit_batch(executor, batch, is_after))
+                    batch = []
+            else:
+                futures.append(executor.submit(self.send_image_for_processing, image_path, step, is_after))
+
+        return futures
+
+    def sweep_captures(self, steps, folder):
+        """
+        Moves the arm to the scanning pose at the first step, then rotates servo 0 through the steps at a constant low velocity,
+        and takes a picture on the video port as it passes each of them, without stopping. The position of servo 0 interpolated
+        at the time of each exposure is saved to image_angles. Motion blur is bounded by sweep_velocity multiplied by the exposure time.
+
+        Parameters
+        ----------
+        steps : list of ints
+            List containing pulse widths of servo 0 where images should be taken, in the order they are passed.
+        folder : str
+            Folder where the images are saved.
+
+        Yields
+        ------
+        step : int
+            The step where the image was taken.
+        image_path : pathlib.Path
+            Path of the image.
+
+        """
+
+        self.sc.init_arm_position(is_inference=True, axis_0_pos=steps[0])
+
+        # The sweep runs in the background and reports the steps as it passes them, the pictures are taken on this thread
+        passed_steps = queue.Queue()
+        timeline = []
+        sweep = self.executors.get("motion").submit(
+            self.sc.sweep, 0, steps[-1], self.config.get("sweep_velocity", 150), steps, passed_steps.put, timeline
+        )
+
+        for _ in steps:
+            step = None
+            while step is None:
+                try:
+                    step = passed_steps.get(timeout=0.1)
+                except queue.Empty:
+                    # The steps are all reported before the sweep finishes, so it can only finish early if a servo command failed
+                    if sweep.done() and passed_steps.empty():
+                        sweep.result()
+                        raise RuntimeError("The sweep finished without passing every step.")
+            image_path = Path(folder).joinpath(f"{step}.jpg")
+
+            capture_started = monotonic()
+            self.camera.capture_still(image_path.as_posix())
+            exposure_time = (capture_started + monotonic()) / 2
+            self.image_angles[image_path.as_posix()] = interpolate_position(timeline, exposure_time)
+
+            yield step, image_path
+
+        sweep.result()
+        # Checked after the sweep, since servo 0 would keep moving in the background otherwise
+        self.scheduler.check_cancelled()
+
+    def submit_batch(self, executor, batch, is_after):
+        """
+        Submits a batch of images to be sent in a single message. A separate future is returned for each image, which is resolved
+        when the answer to the batch arrives, so callers can handle batched and single uploads the same way.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor
+            Executor used to send the images to the Cloud service.
+        batch : list of tuples
+            List of (image_path, step) tuples of the images to be sent.
+        is_after : bool
+            Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
+            been moved to the containers.
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            Futures of the images in the same order as the batch, each resolving to a tuple of (success, step).
+
+        """
+
+        futures = [concurrent.futures.Future() for _ in batch]
+
+        def resolve(batch_future):
+            if batch_future.exception():
+                for future in futures:
+                    future.set_exception(batch_future.exception())
+                return
+            for future, result in zip(futures, batch_future.result()):
+                future.set_result(result)
+
+        executor.submit(self.send_images_batch, batch, is_after).add_done_callback(resolve)
+
+        return futures
+
+    def send_image_for_processing(self, image_path, step, is_after, session_id=None, image_angle=None):
         """
         Takes an image from disk, opens it and send the image bytes directly to the Cloud service. It creates a new connection for each
         image, where the image metadata is sent as headers of the initial HTTP handshake.
@@ -239,6 +800,12 @@ class ArmCommands:
         is_after : bool
             Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
             been moved to the containers.
+        session_id : int
+            Identifier of the session of the image. Defaults to the current session, has to be supplied for background uploads,
+            which might run after the next session started.
+        image_angle : float
+            Position of servo 0 at the exposure of the image, if it was taken while sweeping. Defaults to the one saved in image_angles,
+            has to be supplied for background uploads.
 
         Returns
         -------
@@ -250,7 +817,8 @@ class ArmCommands:
 
         """
 
-        log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": step}
+        session_id = session_id or self.session_id
+        log_args = {"arm_id": self.config["arm_id"], "session_id": session_id, "log_type": step}
 
         self.logger.info(f"Upload execution started", dict(bm_id=1.1, **log_args))
 
@@ -260,27 +828,148 @@ class ArmCommands:
         self.logger.info(f"Bytes read", dict(bm_id=1.2, **log_args))
 
         # Construct headers for initial HTTP handshake
-        headers = json.dumps({
+        headers = {
             "command": "recv_img_after" if is_after else "recv_img_proc",
-            "arm_id": self.arm_id,
-            "session_id": self.session_id,
-            "image_name": Path(image_path).name
-        }).encode('utf8')
-
-        cloud_websocket = websocket.create_connection(self.ws_cloud_url)
+            "arm_id": self.config["arm_id"],
+            "session_id": session_id,
+            "image_name": Path(image_path).name,
+            "return_detections": bool(self.session_map)
+        }
+        image_angle = image_angle if image_angle is not None else self.image_angles.get(Path(image_path).as_posix())
+        if image_angle is not None:
+            headers["image_angle"] = image_angle
+
+        with CLOUD_CONNECT_SECONDS.time():
+            cloud_websocket = websocket.create_connection(self.ws_cloud_url)
 
         # Send image bytes
         self.logger.info(f"Connection made", dict(bm_id=1.3, **log_args))
 
-        cloud_websocket.send_binary(b"___SPLIT___".join([headers, img_bytes]))
+        with UPLOAD_SECONDS.time(target="cloud"):
+            if self.config.get("binary_framing", False):
+                send_frame(cloud_websocket, headers, img_bytes)
+            else:
+                cloud_websocket.send_binary(b"___SPLIT___".join([json.dumps(headers).encode('utf8'), img_bytes]))
+        UPLOAD_BYTES.observe(len(img_bytes), target="cloud")
 
         self.logger.info(f"Bytes sent", dict(bm_id=1.4, **log_args))
         self.logger.info(f"Image {Path(image_path).name} successfully sent to Cloud service.", log_args)
-        success = cloud_websocket.recv()
+        sent = time()
+        result = cloud_websocket.recv()
+        CLOUD_RESPONSE_SECONDS.observe(time() - sent, command=headers["command"])
         self.logger.info(f"Answer received", dict(bm_id=1.5, **log_args))
 
         cloud_websocket.close()
 
+        # In incremental mode the answer contains the detections of the image as well
+        if self.session_map and not is_after:
+            result = json.loads(result)
+
+        if self.recorder:
+            self.recorder.add_cloud_result(Path(image_path).name, is_after, result, time() - sent)
+
+        return self.process_result(image_path, step, result, is_after, session_id)
+
+    def send_images_batch(self, batch, is_after):
+        """
+        Sends multiple images to the Cloud service in a single binary frame and receives the results of all of them in one answer.
+        The duration of the handshake and the upload are recorded, so the size of the next batch can adapt to the connection.
+
+        Parameters
+        ----------
+        batch : list of tuples
+            List of (image_path, step) tuples of the images to be sent.
+        is_after : bool
+            Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
+            been moved to the containers.
+
+        Returns
+        -------
+        results : list of tuples
+            List of (success, step) tuples in the same order as the batch.
+
+        """
+
+        log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_gen"}
+
+        images = []
+        for image_path, _ in batch:
+            with open(image_path, "rb") as img_file:
+                images.append(img_file.read())
+
+        headers = {
+            "command": "recv_img_batch",
+            "arm_id": self.arm_id,
+            "session_id": self.session_id,
+            "is_after": is_after,
+            "return_detections": bool(self.session_map),
+            "images": [{"image_name": Path(image_path).name, "size": len(img)} for (image_path, _), img in zip(batch, images)]
+        }
+        for image, (image_path, _) in zip(headers["images"], batch):
+            if Path(image_path).as_posix() in self.image_angles:
+                image["image_angle"] = self.image_angles[Path(image_path).as_posix()]
+
+        start = time()
+        cloud_websocket = websocket.create_connection(self.ws_cloud_url)
+        connected = time()
+        send_frame(cloud_websocket, headers, *images)
+        sent = time()
+        self.upload_batcher.record(sum(len(img) for img in images), len(images), connected - start, sent - connected)
+        CLOUD_CONNECT_SECONDS.observe(connected - start)
+        UPLOAD_SECONDS.observe(sent - connected, target="cloud")
+        UPLOAD_BYTES.observe(sum(len(img) for img in images), target="cloud")
+        self.logger.info(f"Batch of {len(batch)} images sent to Cloud service.", log_args)
+
+        # The answer contains one result for each image, in the same order as they were sent
+        results = json.loads(cloud_websocket.recv())
+        CLOUD_RESPONSE_SECONDS.observe(time() - sent, command=headers["command"])
+        if self.recorder:
+            for (image_path, _), result in zip(batch, results):
+                self.recorder.add_cloud_result(Path(image_path).name, is_after, result, time() - sent)
+        cloud_websocket.close()
+
+        return [self.process_result(image_path, step, result, is_after) for (image_path, step), result in zip(batch, results)]
+
+    def process_result(self, image_path, step, result, is_after, session_id=None):
+        """
+        Processes the answer of the Cloud service to an image. If the answer contains detections, they are added to the map of the session.
+        Successfully processed images are deleted locally.
+
+        Parameters
+        ----------
+        image_path : str
+            Path of the image on disk which was processed.
+        step : int
+            Identifies the image, corresponds to the pulse width of servo 0 where the image was taken.
+        result : str or dict
+            Answer of the Cloud service. Either a plain success value, or a dict containing the success and the detections.
+        is_after : bool
+            Boolean representing is the current image recording session is for creating an overview stitched image after the objects have
+            been moved to the containers.
+        session_id : int
+            Identifier of the session of the image. Defaults to the current session.
+
+        Returns
+        -------
+        success : bool
+            Boolean representing if image processing was successful.
+        step : int
+            Identifies the image, passed through to report the execution results.
+
+        """
+
+        log_args = {"arm_id": self.config["arm_id"], "session_id": session_id or self.session_id, "log_type": step}
+
+        if isinstance(result, dict):
+            success = result["success"]
+            if self.session_map and not is_after:
+                self.session_map.add_result(step, success, result.get("objects", []), result.get("containers", []))
+        else:
+            success = result
+            # Cloud services which ignore return_detections answer with a plain success value, the image still has to be finished
+            if self.session_map and not is_after:
+                self.session_map.add_result(step, bool(success))
+
         # Delete file locally if successfully processed
         if success:
             self.logger.info(f"Image {Path(image_path).name} successfully processed.", log_args)
@@ -288,12 +977,21 @@ class ArmCommands:
 
         return success, step
 
-    def reset_arm(self):
+    def reset_arm(self, after_image_steps=None):
         """
-        Instructs the arm to return to the start position.
+        Instructs the arm to return to the start position. If after_image_steps are supplied, the arm passes through the scanning
+        positions on its way back and takes the after images, which are uploaded and stitched in the background.
+
+        Parameters
+        ----------
+        after_image_steps : list of ints
+            Optional list containing pulse widths of servo 0 where after images should be taken.
 
         """
 
+        if after_image_steps:
+            self.capture_after_images(after_image_steps)
+
         self.sc.execute_commands(((2, self.sc.start_positions[2]),))
         self.sc.execute_commands((
             (0, self.sc.start_positions[0]),
@@ -302,16 +1000,86 @@ class ArmCommands:
         ), parallel=True)
         self.sc.neutralize_servos()
 
+    def capture_after_images(self, steps):
+        """
+        Takes the images used to create an overview stitched image after the objects have been moved to the containers. The scanning
+        positions are swept starting from the one closest to the current position of the arm, and the pictures are taken while servo 0
+        is moving, without stopping and stabilizing at each of them, so the scan is part of the return path instead of a separate pass.
+        The uploads and the stitching request are scheduled as background jobs, which do not block the next session.
+
+        Parameters
+        ----------
+        steps : list of ints
+            List containing pulse widths of servo 0 where images should be taken.
+
+        """
+
+        log_args = {"arm_id": self.arm_id, "session_id": self.session_id, "log_type": "comm_exec"}
+        after_path = Path(self.curr_sess_path).joinpath("after")
+        os.makedirs(after_path, exist_ok=True)
+
+        # Sweep towards the scanning position farther from the arm, so that no position is passed twice
+        steps = sorted(steps, reverse=abs(self.sc.curr_positions[0] - max(steps)) < abs(self.sc.curr_positions[0] - min(steps)))
+
+        for step, image_path in self.sweep_captures(steps, after_path):
+            self.scheduler.submit("upload_after", image_path.as_posix(), step, self.session_id, self.image_angles[image_path.as_posix()])
+
+        self.scheduler.submit("stitch", self.session_id)
+        self.logger.info("All after pictures taken and uploads started.", dict(bm_id=15, **log_args))
+
+    def upload_after_image(self, image_path, step, session_id, image_angle=None):
+        """
+        Uploads an after image in the background. While the arm is moving, uploads are slowed down to leave bandwidth for the session.
+        Images which no longer exist were already processed, the Cloud service answered before a restart interrupted the job.
+
+        """
+
+        if not os.path.exists(image_path):
+            return
+
+        self.scheduler.throttle(os.path.getsize(image_path))
+        self.send_image_for_processing(image_path, step, True, session_id, image_angle)
+
+    def request_stitching(self, session_id):
+        """
+        Requests the Cloud service to stitch the after images of a session. Scheduled with a lower priority than the uploads,
+        so it is executed after the after images of the session are uploaded.
+
+        Parameters
+        ----------
+        session_id : int
+            Identifier of the session whose after images should be stitched.
+
+        """
+
+        cloud_websocket = websocket.create_connection(self.ws_cloud_url)
+        cloud_websocket.send(json.dumps({
+            "command": "stitch_after_image",
+            "arm_id": self.config["arm_id"],
+            "session_id": session_id
+        }))
+        cloud_websocket.close()
+
+        log_args = {"arm_id": self.config["arm_id"], "session_id": session_id, "log_type": "comm_exec"}
+        self.logger.info("Stitching after images started.", dict(bm_id=16, **log_args))
+
     def close(self):
         """
-        Closes the session: stops the camera in case it's recording, moves the arm to starting position and neutralizes the servos.
+        Closes the session: waits for the running jobs to finish, stops the camera in case it's recording, moves the arm to starting position,
+        neutralizes the servos and shuts down the thread pools. A running session is aborted at its next check, see JobScheduler.stop.
+        The metrics of the arm are removed, so they do not keep it alive.
 
         """
 
+        self.scheduler.stop()
         if self.camera.camera.recording:
             self.camera.stop()
         self.reset_arm()
         self.sc.neutralize_servos()
+        self.executors.shutdown()
+        for lane in self.scheduler.queues:
+            JOB_QUEUE_DEPTH.untrack(arm_id=self.config["arm_id"], lane=lane)
+        STORAGE_BYTES.untrack(subfolder=self.storage.subfolder)
 
 
 # Manual commands to use separate functionalities. Might be useful later.
@@ -4,12 +4,23 @@ and take inference pictures.
 
 """
 
-from picamera import PiCamera
+import numpy as np
 from time import sleep
 
+from metrics import REGISTRY
+
+try:
+    from picamera import PiCamera
+except ImportError:
+    # Only simulated cameras can be used without picamera
+    PiCamera = None
+
+
+CAPTURE_SECONDS = REGISTRY.histogram("camera_capture_seconds", "Duration of the captures, excluding the preview.")
+
 
 class Camera:
-    def __init__(self, resolution=(1640, 1232), framerate=30):
+    def __init__(self, resolution=(1640, 1232), framerate=30, camera_num=0, camera=None):
         """
         This class includes the methods to record video and take a picture.
 
@@ -24,9 +35,15 @@ class Camera:
             less blurred video and training pictures. The camera supports 40 fps at this resoluton, but
             the h264 codec cannot handle it, so 30 needs to be used here.
 
+        camera_num : int
+            Index of the camera to be used on boards with multiple camera ports, like the Compute Module.
+
+        camera : object
+            Optional object implementing the interface of PiCamera, used instead of the real camera. Used for simulated arms.
+
         """
 
-        self.camera = PiCamera()
+        self.camera = camera or PiCamera(camera_num=camera_num)
         self.camera.resolution = resolution
         self.camera.framerate = framerate
 
@@ -59,5 +76,46 @@ class Camera:
 
         self.camera.start_preview()
         sleep(0.5)
-        self.camera.capture(path)
+        with CAPTURE_SECONDS.time(kind="picture"):
+            self.camera.capture(path)
         self.camera.stop_preview()
+
+    def capture_still(self, path):
+        """
+        Takes a full resolution picture on the video port, without preview and without waiting. Used while the arm is moving,
+        where the capture has to happen as close as possible to the requested moment.
+
+        Parameters
+        ----------
+        path : str
+            Path where the taken image should be saved.
+
+        """
+
+        with CAPTURE_SECONDS.time(kind="still"):
+            self.camera.capture(path, use_video_port=True)
+
+    def capture_frame(self, resolution=(160, 128)):
+        """
+        Captures a low resolution grayscale frame on the video port, without preview and without saving it to disk.
+        Used for fast local checks, where a full resolution picture would be too slow.
+
+        Parameters
+        ----------
+        resolution : tuple
+            Resolution of the frame in the format of (width, height). The width has to be a multiple of 32 and the height a multiple
+            of 16, since the YUV buffer is padded otherwise.
+
+        Returns
+        -------
+        frame : numpy.ndarray
+            Array of the luminance values with the shape of (height, width).
+
+        """
+
+        width, height = resolution
+        buffer = np.empty((width * height * 3 // 2,), dtype=np.uint8)
+        with CAPTURE_SECONDS.time(kind="frame"):
+            self.camera.capture(buffer, format="yuv", resize=resolution, use_video_port=True)
+
+        return buffer[:width * height].reshape((height, width))
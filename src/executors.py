@@ -0,0 +1,141 @@
+"""
+Named, bounded thread pools shared by the components of an arm. Creating a ThreadPoolExecutor for every parallel move or every session
+costs a thread start per task, and executors which are never shut down keep their threads alive, which adds up over days of uptime.
+Instead, every arm has a registry of long-lived pools, which are created on first use and shut down when the arm is closed.
+
+"""
+
+import threading
+import concurrent.futures
+
+from metrics import REGISTRY
+
+
+EXECUTOR_THREADS = REGISTRY.gauge("executor_threads", "Number of threads started by the pools.")
+EXECUTOR_ACTIVE = REGISTRY.gauge("executor_active_tasks", "Number of tasks being executed by the pools.")
+EXECUTOR_QUEUED = REGISTRY.gauge("executor_queued_tasks", "Number of tasks waiting for a free thread of the pools.")
+
+
+class PoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, name, max_workers):
+        """
+        ThreadPoolExecutor which counts its running and waiting tasks. Its threads are named after the pool, like motion_0.
+
+        Parameters
+        ----------
+        name : str
+            Name of the pool.
+        max_workers : int
+            Maximum number of threads of the pool.
+
+        """
+
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.active = 0
+        self.queued = 0
+        self.counts_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        def run():
+            with self.counts_lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.counts_lock:
+                    self.active -= 1
+
+        with self.counts_lock:
+            self.queued += 1
+        future = super().submit(run)
+        future.add_done_callback(self.release_cancelled)
+
+        return future
+
+    def release_cancelled(self, future):
+        # Cancelled tasks never run, so they would be counted as waiting forever
+        if future.cancelled():
+            with self.counts_lock:
+                self.queued -= 1
+
+    def stats(self):
+        """
+        Returns the counters of the pool.
+
+        Returns
+        -------
+        stats : dict
+            Number of started threads, and number of running and waiting tasks.
+
+        """
+
+        with self.counts_lock:
+            return {"threads": len(self._threads), "active": self.active, "queued": self.queued}
+
+
+class ExecutorRegistry:
+    def __init__(self, sizes, owner=""):
+        """
+        Keeps the pools of an arm by name.
+
+        Parameters
+        ----------
+        sizes : dict
+            Maximum number of threads of each pool, keyed by the name of the pool. Only these pools can be created.
+        owner : str
+            Identifier of the arm, used to label the metrics of the pools.
+
+        """
+
+        self.sizes = dict(sizes)
+        self.owner = owner
+        self.pools = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the pool of the given name, creating it on first use.
+
+        Raises
+        ------
+        RuntimeError
+            If the registry is already shut down.
+
+        """
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError(f"Cannot use the {name} pool after shutdown.")
+
+            if name not in self.pools:
+                pool = PoolExecutor(name, self.sizes[name])
+                self.pools[name] = pool
+                EXECUTOR_THREADS.track(lambda: pool.stats()["threads"], arm_id=self.owner, pool=name)
+                EXECUTOR_ACTIVE.track(lambda: pool.stats()["active"], arm_id=self.owner, pool=name)
+                EXECUTOR_QUEUED.track(lambda: pool.stats()["queued"], arm_id=self.owner, pool=name)
+
+            return self.pools[name]
+
+    def stats(self):
+        with self.lock:
+            pools = dict(self.pools)
+
+        return {name: pool.stats() for name, pool in pools.items()}
+
+    def shutdown(self, wait=True):
+        """
+        Shuts down every pool. Tasks which are already submitted are finished if wait is true.
+
+        """
+
+        with self.lock:
+            self.closed = True
+            pools = dict(self.pools)
+
+        for name, pool in pools.items():
+            pool.shutdown(wait=wait)
+            for gauge in (EXECUTOR_THREADS, EXECUTOR_ACTIVE, EXECUTOR_QUEUED):
+                gauge.untrack(arm_id=self.owner, pool=name)
@@ -0,0 +1,227 @@
+"""
+Drives multiple arms from a single process. The arms share one connection to the Control Panel and one reachability monitor of the
+Cloud service, while the sessions of each arm run in their own thread on their own servos, camera and magnet.
+The arms are listed in the config file under the key "arms", each of them overriding the settings of the config file:
+
+    arms:
+      - arm_id: ARM001
+        servo_pins: [14, 15, 18, 24, 25]
+        magnet_pin: 23
+        camera_num: 0
+
+Run `python fleet.py --benchmark` to measure how the runtime scales with the number of arms on simulated hardware.
+
+"""
+
+import os
+import gc
+import random
+import argparse
+import tempfile
+import websockets
+import concurrent.futures
+from time import sleep, time
+
+from main import Main, HEARTBEAT_SECONDS
+from arm_commands import ArmCommands
+from simulated_hardware import create_backends
+
+
+class Fleet(Main):
+    """
+    Multiplexes the heartbeats and sessions of multiple arms over a single connection to the Control Panel.
+
+    Parameters
+    ----------
+    heart_rate : int
+        Length of interval in seconds in which the connection checks and status reports are executed.
+    is_dev : bool
+        Controls whether the development or production config file should be loaded.
+    simulated : bool
+        If true, the arms run on simulated hardware.
+
+    """
+
+    def __init__(self, heart_rate=3, is_dev=False, simulated=False):
+        self.simulated = simulated
+        super().__init__(heart_rate, is_dev)
+
+    def create_commands(self):
+        """
+        Creates the commands of every arm listed in the config file.
+
+        Returns
+        -------
+        commands : dict
+            ArmCommands instances keyed by arm_id.
+
+        """
+
+        return {
+            arm["arm_id"]: ArmCommands(self.config_path, arm=arm, backends=create_backends() if self.simulated else None)
+            for arm in self.config["arms"]
+        }
+
+    async def heartbeat(self):
+        """
+        Checks the reachability of the Cloud service once, then reports it to the Control Panel for every arm.
+
+        Returns
+        -------
+        should_start_sessions : dict
+            0 or 1 for every arm_id, representing if a session should be started on the arm.
+
+        """
+
+        try:
+            cloud_conn_status = await self.check_cloud()
+
+            return {arm_id: await self.report_status(arm_id, cloud_conn_status) for arm_id in self.commands}
+        except websockets.exceptions.ConnectionClosedError:
+            print("WebSockets connection closed.")
+            return {}
+
+    def control_arm_id(self):
+        # Fleet configs may not have a top level arm_id, the first arm represents the fleet then
+        return self.config.get("arm_id") or self.config["arms"][0]["arm_id"]
+
+    def set_profiling(self, arm_id, enabled):
+        self.commands[arm_id].profiling = enabled
+
+    def start_sessions(self, should_start_sessions):
+        """
+        Schedules a session on every arm where it was requested, unless a session of the arm is already scheduled or running.
+        Every arm has its own scheduler, so the sessions of different arms run in parallel.
+
+        Parameters
+        ----------
+        should_start_sessions : dict
+            0 or 1 for every arm_id, representing if a session should be started on the arm.
+
+        """
+
+        for arm_id, should_start_session in should_start_sessions.items():
+            if should_start_session:
+                self.commands[arm_id].scheduler.submit("sort", unique=True)
+
+
+def run_workload(arm, steps, commands):
+    """
+    Executes the motion and capture part of a session without connecting to any server: scans the area, moves every object to
+    its container and resets the arm.
+
+    """
+
+    arm.sc.init_arm_position(is_inference=True)
+    sess_path = arm.storage.create_next_session_folder()
+    for step in steps:
+        arm.sc.execute_commands([(0, step)])
+        arm.camera.take_picture(f"{sess_path}/{step}.jpg")
+
+    for obj_pos, cont_pos in commands:
+        arm.sc.move_to_position(obj_pos)
+        arm.magnet.on()
+        arm.sc.move_to_position(cont_pos, is_container=True)
+        arm.magnet.off()
+
+    arm.reset_arm()
+
+
+def current_rss_mb():
+    """
+    Returns the current resident memory of the process in megabytes. Unlike ru_maxrss, which is the peak of the whole process,
+    this can be compared between the iterations of a benchmark.
+
+    """
+
+    with open("/proc/self/statm", "r") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def benchmark(config_path, arm_counts=(1, 2, 4, 8, 16), n_commands=3, seed=0):
+    """
+    Runs the same workload concurrently on an increasing number of simulated arms in a single process. Each iteration saves its files
+    under a temporary folder, which is deleted together with the arms afterwards, so no files and no memory are carried over.
+
+    Parameters
+    ----------
+    config_path : str
+        Path to the config file.
+    arm_counts : tuple of ints
+        Numbers of arms to be benchmarked.
+    n_commands : int
+        Number of objects moved by each arm.
+    seed : int
+        Seed of the random number generator used to generate the positions of the objects.
+
+    Returns
+    -------
+    results : dict
+        Wall-clock duration, number of pigpio calls, resident memory at the end of the workload and its growth during the iteration
+        for each number of arms.
+
+    """
+
+    rng = random.Random(seed)
+    steps = list(reversed(range(1000, 2000, 200)))
+    commands = [((rng.uniform(1000, 1800), rng.uniform(1100, 2000)), (rng.uniform(1000, 1800), rng.uniform(1100, 2000)))
+                for _ in range(n_commands)]
+
+    results = {}
+    for n_arms in arm_counts:
+        rss_before = current_rss_mb()
+        with tempfile.TemporaryDirectory(prefix="sorterbot_benchmark_") as root:
+            arms = [
+                ArmCommands(config_path, arm={"arm_id": f"SIM{i:03d}"}, backends=create_backends(), root=root) for i in range(n_arms)
+            ]
+
+            start = time()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_arms) as executor:
+                list(executor.map(lambda arm: run_workload(arm, steps, commands), arms))
+
+            rss = current_rss_mb()
+            results[n_arms] = {
+                "duration": time() - start,
+                "pigpio_calls": sum(arm.sc.pi.n_calls for arm in arms),
+                "rss_mb": rss,
+                "rss_growth_mb": rss - rss_before
+            }
+
+            for arm in arms:
+                arm.close()
+            del arms
+            gc.collect()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive multiple SorterBot arms from one process.")
+    parser.add_argument("--simulated", action="store_true", help="Run the arms on simulated hardware.")
+    parser.add_argument("--benchmark", action="store_true", help="Benchmark 1-16 simulated arms and exit.")
+    parser.add_argument("--dev", action="store_true", help="Load the development config file.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for n_arms, result in benchmark(f"arm_config{'_dev' if args.dev else ''}.yaml").items():
+            print(f"{n_arms:>2} arms: {result['duration']:.2f}s, {result['pigpio_calls']} pigpio calls, "
+                  f"{result['rss_mb']:.1f} MB RSS ({result['rss_growth_mb']:+.1f} MB)")
+    else:
+        fleet = Fleet(is_dev=args.dev, simulated=args.simulated)
+        try:
+            while True:
+                # Open connection to Control Panel if it's not open
+                if not fleet.control_websocket or not fleet.control_websocket.open:
+                    print("Control Panel is offline, connecting...")
+                    fleet.loop.run_until_complete(fleet.connect_control())
+
+                heartbeat_started = time()
+                should_start_sessions = fleet.loop.run_until_complete(fleet.heartbeat())
+                HEARTBEAT_SECONDS.observe(time() - heartbeat_started)
+                fleet.start_sessions(should_start_sessions)
+                sleep(fleet.reachability.next_delay())
+        except KeyboardInterrupt:
+            for commands in fleet.commands.values():
+                commands.close()
+            fleet.loop.run_until_complete(fleet.control_websocket.close())
+            print("WebSocket connection to Control Panel closed.")
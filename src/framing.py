@@ -0,0 +1,197 @@
+"""
+Binary framing of the messages carrying images to the Cloud service. A frame consists of a fixed-size prefix, the JSON encoded
+headers and the raw payload. The prefix contains the lengths of the other two parts, so the receiver can locate the payload
+without scanning it for a delimiter, and the sender does not need to build a concatenated copy of the image.
+
+Layout of the prefix (big-endian, 12 bytes):
+
+    magic (3 bytes, b"SBF") | version (uint8) | header length (uint32) | payload length (uint32)
+
+Run this file directly to benchmark the encoding and decoding cost compared to the legacy ___SPLIT___ delimiter.
+
+"""
+
+import os
+import json
+import struct
+import websocket
+from time import perf_counter
+
+
+MAGIC = b"SBF"
+VERSION = 1
+PREFIX = struct.Struct(">3sBII")
+LEGACY_DELIMITER = b"___SPLIT___"
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(headers, *payloads):
+    """
+    Encodes the headers and the prefix of a frame. The payloads are not copied, they have to be sent right after the returned bytes.
+
+    Parameters
+    ----------
+    headers : dict
+        JSON serializable metadata of the payload.
+    payloads : bytes-like
+        Raw bytes of the payload, usually an image. In case of batches, the payload is the concatenation of multiple images.
+
+    Returns
+    -------
+    prefix : bytes
+        Fixed-size prefix followed by the encoded headers.
+
+    """
+
+    encoded_headers = json.dumps(headers).encode("utf8")
+
+    return PREFIX.pack(MAGIC, VERSION, len(encoded_headers), sum(len(payload) for payload in payloads)) + encoded_headers
+
+
+def decode_frame(data):
+    """
+    Reference decoder of a frame. The returned payload is a view of the received data, so it is not copied.
+
+    Parameters
+    ----------
+    data : bytes-like
+        A complete frame as received from the WebSocket connection.
+
+    Returns
+    -------
+    headers : dict
+        Decoded metadata of the payload.
+    payload : memoryview
+        View of the payload bytes.
+
+    """
+
+    data = memoryview(data)
+    if len(data) < PREFIX.size:
+        raise FrameError("Frame is shorter than the prefix.")
+
+    magic, version, header_length, payload_length = PREFIX.unpack_from(data)
+    if magic != MAGIC:
+        raise FrameError("Frame does not start with the magic bytes.")
+    if version != VERSION:
+        raise FrameError(f"Unsupported frame version: {version}.")
+
+    payload_start = PREFIX.size + header_length
+    if len(data) != payload_start + payload_length:
+        raise FrameError("Frame length does not match the lengths in the prefix.")
+
+    headers = json.loads(bytes(data[PREFIX.size:payload_start]))
+
+    return headers, data[payload_start:]
+
+
+def decode_message(data):
+    """
+    Decodes a message which is either a frame or a legacy message, where the headers and the payload are separated by ___SPLIT___.
+
+    """
+
+    if bytes(data[:len(MAGIC)]) == MAGIC:
+        return decode_frame(data)
+
+    headers, payload = bytes(data).split(LEGACY_DELIMITER, 1)
+
+    return json.loads(headers), memoryview(payload)
+
+
+def split_batch(headers, payload):
+    """
+    Splits the payload of a batch frame into the individual images, using the sizes listed in the headers.
+
+    Parameters
+    ----------
+    headers : dict
+        Decoded headers of a batch frame, containing the list of images as {"image_name": str, "size": int}.
+    payload : memoryview
+        View of the payload bytes.
+
+    Returns
+    -------
+    images : list of tuples
+        List of (image headers, image payload) tuples, where the payloads are views of the original payload.
+
+    """
+
+    images = []
+    offset = 0
+    for image in headers["images"]:
+        images.append((image, payload[offset:offset + image["size"]]))
+        offset += image["size"]
+
+    if offset != len(payload):
+        raise FrameError("Sizes of the images do not add up to the payload length.")
+
+    return images
+
+
+def send_frame(cloud_websocket, headers, *payloads):
+    """
+    Sends a frame as WebSocket fragments, the first containing the prefix and the headers, and one more for each payload,
+    so the payloads are never concatenated with the headers or with each other. The receiver gets the reassembled message.
+
+    Parameters
+    ----------
+    cloud_websocket : websocket.WebSocket
+        Open connection to the Cloud service.
+    headers : dict
+        JSON serializable metadata of the payload.
+    payloads : bytes
+        Raw bytes of the payloads.
+
+    """
+
+    cloud_websocket.send_frame(websocket.ABNF.create_frame(encode_frame(headers, *payloads), websocket.ABNF.OPCODE_BINARY, 0))
+    for i, payload in enumerate(payloads):
+        cloud_websocket.send_frame(websocket.ABNF.create_frame(payload, websocket.ABNF.OPCODE_CONT, int(i == len(payloads) - 1)))
+
+
+def benchmark(size_mb=4, repeat=50):
+    """
+    Measures the encoding and decoding cost per MB of the binary frames and the legacy delimiter based messages.
+
+    Parameters
+    ----------
+    size_mb : int
+        Size of the random payload in megabytes.
+    repeat : int
+        Number of times each operation is repeated.
+
+    Returns
+    -------
+    results : dict
+        Milliseconds per MB for each operation.
+
+    """
+
+    headers = {"command": "recv_img_proc", "arm_id": "ARM001", "session_id": 1, "image_name": "1800.jpg"}
+    payload = os.urandom(size_mb * 1024 * 1024)
+    encoded_headers = json.dumps(headers).encode("utf8")
+
+    def measure(function):
+        start = perf_counter()
+        for _ in range(repeat):
+            function()
+        return (perf_counter() - start) * 1000 / repeat / size_mb
+
+    legacy_message = LEGACY_DELIMITER.join([encoded_headers, payload])
+    frame = encode_frame(headers, payload) + payload
+
+    return {
+        "legacy_encode": measure(lambda: LEGACY_DELIMITER.join([json.dumps(headers).encode("utf8"), payload])),
+        "legacy_decode": measure(lambda: decode_message(legacy_message)),
+        "frame_encode": measure(lambda: encode_frame(headers, payload)),
+        "frame_decode": measure(lambda: decode_frame(frame))
+    }
+
+
+if __name__ == "__main__":
+    for operation, ms_per_mb in benchmark().items():
+        print(f"{operation:>15}: {ms_per_mb:.4f} ms/MB")
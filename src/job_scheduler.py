@@ -0,0 +1,296 @@
+"""
+Schedules the jobs of an arm, like sort sessions, training recordings and uploads. Jobs which move the arm are executed one by one
+in the order of their priorities, while background jobs run on a separate worker, so uploads never delay a session, and are
+throttled while the arm is moving, so they do not compete with the session for CPU and bandwidth. Failed persistent jobs, like uploads
+which could not reach the server, are kept in the saved file and retried after the next restart, until they run out of attempts.
+
+"""
+
+import os
+import json
+import heapq
+import logging
+import itertools
+import threading
+from time import sleep, time
+
+
+class JobCancelled(Exception):
+    """
+    Raised by check_cancelled inside a job, when the scheduler is being stopped.
+
+    """
+
+
+class JobScheduler:
+    def __init__(self, path=None, throttled_rate=200000, logger=None, arm_id=None, max_attempts=3):
+        """
+        Keeps a priority queue for the jobs using the arm and another for background jobs. Persistent jobs are saved to disk
+        and resumed after a restart.
+
+        Parameters
+        ----------
+        path : str
+            Path of the JSON file where the persistent jobs are saved. If None, jobs are not persisted.
+        throttled_rate : int
+            Rate limit of background uploads in bytes per second while the arm is moving.
+        logger : logging.Logger
+            Logger of the arm, used to report failed jobs with their tracebacks.
+        arm_id : str
+            Identifier of the arm, sent with the logs.
+        max_attempts : int
+            Number of times a persistent job is started before it is dropped, counting the attempts interrupted by a restart.
+
+        """
+
+        self.path = path
+        self.throttled_rate = throttled_rate
+        self.logger = logger or logging.getLogger(__name__)
+        self.arm_id = arm_id
+        self.max_attempts = max_attempts
+        # Persistent jobs which raised an exception, kept until the next restart
+        self.failed = []
+        self.handlers = {}
+        self.queues = {"arm": [], "background": []}
+        self.running = {"arm": None, "background": None}
+        self.wait_times = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.arm_busy = threading.Event()
+        self.cancelled = threading.Event()
+        self.stopped = False
+        self.workers = []
+
+    def register(self, kind, handler, priority, uses_arm=False, persistent=False):
+        """
+        Registers a kind of job.
+
+        Parameters
+        ----------
+        kind : str
+            Name of the job kind.
+        handler : function
+            Function executing the job, called with the arguments supplied on submission.
+        priority : int
+            Lower numbers are executed first.
+        uses_arm : bool
+            If true, the job moves the arm, so it is executed by the arm worker and other jobs are throttled while it runs.
+        persistent : bool
+            If true, pending jobs of this kind are saved to disk and resumed after a restart. The arguments have to be JSON serializable.
+
+        """
+
+        self.handlers[kind] = {"handler": handler, "priority": priority, "lane": "arm" if uses_arm else "background", "persistent": persistent}
+
+    def submit(self, kind, *args, unique=False, created_at=None, attempts=0):
+        """
+        Adds a job to the queue of its lane.
+
+        Parameters
+        ----------
+        kind : str
+            Name of a registered job kind.
+        args : any
+            Arguments passed to the handler of the job.
+        unique : bool
+            If true, the job is not added when a job of the same kind is already pending or running.
+        created_at : float
+            Timestamp of the creation of the job, used when resuming persisted jobs.
+        attempts : int
+            Number of times the job was already started, used when resuming persisted jobs.
+
+        Returns
+        -------
+        job : dict
+            The added job, or None if it was not added because of unique.
+
+        """
+
+        lane = self.handlers[kind]["lane"]
+        with self.condition:
+            if unique and self.is_scheduled(kind):
+                return None
+
+            job = {"kind": kind, "args": list(args), "created_at": created_at or time(), "attempts": attempts}
+            heapq.heappush(self.queues[lane], (self.handlers[kind]["priority"], next(self.counter), job))
+            if self.handlers[kind]["persistent"]:
+                self.save()
+            self.condition.notify_all()
+
+        return job
+
+    def is_scheduled(self, kind):
+        lane = self.handlers[kind]["lane"]
+        running = self.running[lane]
+
+        return (running and running["kind"] == kind) or any(job["kind"] == kind for _, _, job in self.queues[lane])
+
+    def start(self):
+        """
+        Resumes the persisted jobs and starts the workers of both lanes.
+
+        """
+
+        self.load()
+        for lane in self.queues:
+            worker = threading.Thread(target=self.work, args=(lane,), name=f"jobs-{lane}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stops the workers after their current jobs are finished. Jobs which call check_cancelled, like sort sessions, are aborted
+        at their next check. Pending persistent jobs remain saved.
+
+        """
+
+        self.cancelled.set()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        for worker in self.workers:
+            worker.join()
+
+    def work(self, lane):
+        """
+        Executes the jobs of a lane one by one in the order of their priorities.
+
+        """
+
+        while True:
+            with self.condition:
+                while not self.queues[lane] and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                _, _, job = heapq.heappop(self.queues[lane])
+                # Counted before running, so jobs which crash the process are not retried forever either
+                job["attempts"] = job.get("attempts", 0) + 1
+                self.running[lane] = job
+                self.record_wait_time(job)
+                if self.handlers[job["kind"]]["persistent"]:
+                    self.save()
+
+            if lane == "arm":
+                self.arm_busy.set()
+            try:
+                self.handlers[job["kind"]]["handler"](*job["args"])
+            except JobCancelled:
+                log_args = {"arm_id": self.arm_id, "session_id": None, "log_type": "comm_gen"}
+                self.logger.warning(f"Job {job['kind']} cancelled.", log_args)
+            except Exception:
+                log_args = {"arm_id": self.arm_id, "session_id": None, "log_type": "comm_gen"}
+                self.logger.exception(f"Job {job['kind']} failed with arguments {job['args']}.", log_args)
+                if self.handlers[job["kind"]]["persistent"]:
+                    if job["attempts"] < self.max_attempts:
+                        with self.condition:
+                            self.failed.append(job)
+                    else:
+                        self.logger.error(f"Job {job['kind']} dropped after {job['attempts']} attempts.", log_args)
+            finally:
+                if lane == "arm":
+                    self.arm_busy.clear()
+                with self.condition:
+                    self.running[lane] = None
+                    if self.handlers[job["kind"]]["persistent"]:
+                        self.save()
+
+    def check_cancelled(self):
+        """
+        Called by long running jobs at points where they can stop safely.
+
+        Raises
+        ------
+        JobCancelled
+            If the scheduler is being stopped.
+
+        """
+
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def record_wait_time(self, job):
+        wait_time = time() - job["created_at"]
+        stats = self.wait_times.setdefault(job["kind"], {"count": 0, "total": 0, "max": 0})
+        stats["count"] += 1
+        stats["total"] += wait_time
+        stats["max"] = max(stats["max"], wait_time)
+
+    def throttle(self, n_bytes):
+        """
+        Slows down background transfers to throttled_rate while the arm is moving. Can be passed as the progress callback of uploads,
+        which is called with the number of bytes transferred since the previous call.
+
+        Parameters
+        ----------
+        n_bytes : int
+            Number of bytes transferred since the previous call.
+
+        """
+
+        if self.arm_busy.is_set():
+            sleep(n_bytes / self.throttled_rate)
+
+    def stats(self):
+        """
+        Returns the metrics of the queues.
+
+        Returns
+        -------
+        stats : dict
+            Number of pending jobs for each lane, number of failed persistent jobs, and the number of started jobs and their average
+            and maximum wait time in seconds for each kind.
+
+        """
+
+        with self.condition:
+            return {
+                "queue_depth": {lane: len(queue) for lane, queue in self.queues.items()},
+                "failed": len(self.failed),
+                "wait_time": {
+                    kind: {"count": stats["count"], "avg": stats["total"] / stats["count"], "max": stats["max"]}
+                    for kind, stats in self.wait_times.items()
+                }
+            }
+
+    def save(self):
+        """
+        Saves the pending, running and failed persistent jobs to disk. Has to be called while holding the condition.
+
+        """
+
+        if not self.path:
+            return
+
+        jobs = [job for queue in self.queues.values() for _, _, job in queue] + [job for job in self.running.values() if job] + self.failed
+        jobs = [job for job in jobs if self.handlers[job["kind"]]["persistent"]]
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as jobs_file:
+            json.dump(jobs, jobs_file)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """
+        Resubmits the persistent jobs saved by a previous run, including the ones which failed. Jobs of unknown kinds, and jobs
+        which already ran out of attempts, are dropped.
+
+        """
+
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r") as jobs_file:
+            jobs = json.load(jobs_file)
+
+        # Jobs submitted before starting the workers are already saved to the file
+        with self.condition:
+            queued = [job for queue in self.queues.values() for _, _, job in queue]
+
+        for job in jobs:
+            if job.get("attempts", 0) >= self.max_attempts:
+                log_args = {"arm_id": self.arm_id, "session_id": None, "log_type": "comm_gen"}
+                self.logger.error(f"Job {job['kind']} dropped after {job['attempts']} attempts.", log_args)
+            elif job["kind"] in self.handlers and job not in queued:
+                self.submit(job["kind"], *job["args"], created_at=job["created_at"], attempts=job.get("attempts", 0))
@@ -18,6 +18,10 @@ class Logger:
 
         self.logger = logging.getLogger('SORTERBOT_RASPBERRY')
 
+        # Arms of a fleet share the logger, handlers are only added once to avoid duplicated logs
+        if self.logger.handlers:
+            return
+
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
         handler = logging.StreamHandler()
@@ -5,25 +5,53 @@ on and off by supplying a logical high and logical low signal to the appropriate
 
 """
 
-import RPi.GPIO as GPIO
+from time import sleep, time
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Only simulated magnets can be used without RPi.GPIO
+    GPIO = None
 
 
 class MagnetControl:
-    def __init__(self, pin=23):
+    def __init__(self, pin=23, gpio=None, rise_dwell=0.0, release_dwell=0.0, pre_energize=1.0, early_release=1.0):
         """
-        This class includes methods to turn the magnet on and off.
+        This class includes methods to turn the magnet on and off. The magnetic field needs some time to build up and to collapse,
+        so the magnet has to stay on for rise_dwell before lifting an object and off for release_dwell before moving away from a
+        container. To avoid waiting for the whole dwell time, the magnet can be switched while the arm is still moving: turned on during
+        the final part of the descent to the object and turned off during the final part of the approach to the container.
+        Timestamps of the switches are recorded, so the dwell times can be tuned together with the pick success rate.
 
         Parameters
         ----------
         pin : int
             GPIO number of the pin which is used to control the magnet.
+        gpio : module
+            Optional object implementing the interface of RPi.GPIO, used for simulated arms.
+        rise_dwell : float
+            Seconds the magnet needs to be on before lifting an object.
+        release_dwell : float
+            Seconds the magnet needs to be off before moving away from a container.
+        pre_energize : float
+            Fraction of the final descent to the object after which the magnet is turned on. 1 means it is turned on after arriving.
+        early_release : float
+            Fraction of the final approach to the container after which the magnet is turned off. 1 means it is turned off after arriving.
 
         """
 
         self.pin = pin
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(self.pin, GPIO.OUT)
+        self.gpio = gpio or GPIO
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setwarnings(False)
+        self.gpio.setup(self.pin, self.gpio.OUT)
+
+        self.rise_dwell = rise_dwell
+        self.release_dwell = release_dwell
+        self.pre_energize = pre_energize
+        self.early_release = early_release
+        self.is_on = False
+        self.events = {}
 
     def on(self):
         """
@@ -31,7 +59,9 @@ class MagnetControl:
 
         """
 
-        GPIO.output(self.pin, GPIO.HIGH)
+        self.gpio.output(self.pin, self.gpio.HIGH)
+        self.is_on = True
+        self.mark("on")
 
     def off(self):
         """
@@ -39,4 +69,95 @@ class MagnetControl:
 
         """
 
-        GPIO.output(self.pin, GPIO.LOW)
+        self.gpio.output(self.pin, self.gpio.LOW)
+        self.is_on = False
+        self.mark("off")
+
+    def mark(self, event):
+        """
+        Records the timestamp of an event of the current pick and place cycle.
+
+        """
+
+        self.events[event] = time()
+
+    def start_cycle(self):
+        """
+        Clears the events of the previous cycle.
+
+        """
+
+        self.events = {}
+        self.mark("start")
+
+    def pick_trigger(self):
+        """
+        Returns the trigger to be passed to ServoControl.move_to_position, which turns the magnet on during the descent to the object.
+
+        Returns
+        -------
+        trigger : tuple
+            Tuple of (fraction, callback), or None if the magnet should only be turned on after arriving.
+
+        """
+
+        return (self.pre_energize, self.on) if self.pre_energize < 1 else None
+
+    def release_trigger(self):
+        """
+        Returns the trigger to be passed to ServoControl.move_to_position, which turns the magnet off during the approach to the container.
+
+        Returns
+        -------
+        trigger : tuple
+            Tuple of (fraction, callback), or None if the magnet should only be turned off after arriving.
+
+        """
+
+        return (self.early_release, self.off) if self.early_release < 1 else None
+
+    def settle_pick(self):
+        """
+        Turns the magnet on if it is not on yet, and waits until it has been on for rise_dwell.
+
+        """
+
+        if not self.is_on:
+            self.on()
+        sleep(max(0, self.rise_dwell - (time() - self.events["on"])))
+        self.mark("picked")
+
+    def settle_release(self):
+        """
+        Turns the magnet off if it is not off yet, and waits until it has been off for release_dwell.
+
+        """
+
+        if self.is_on:
+            self.off()
+        sleep(max(0, self.release_dwell - (time() - self.events["off"])))
+        self.mark("released")
+
+    def cycle_times(self):
+        """
+        Calculates the durations of the current pick and place cycle from the recorded events.
+
+        Returns
+        -------
+        cycle_times : dict
+            Seconds the magnet was on before lifting (pick_dwell) and off before moving away (release_dwell), and the duration
+            of the whole cycle (cycle). Missing events are omitted.
+
+        """
+
+        def duration(start, end):
+            if start in self.events and end in self.events:
+                return round(self.events[end] - self.events[start], 3)
+
+        times = {
+            "pick_dwell": duration("on", "picked"),
+            "release_dwell": duration("off", "released"),
+            "cycle": duration("start", "released")
+        }
+
+        return {key: value for key, value in times.items() if value is not None}
@@ -1,12 +1,17 @@
 import json
 import asyncio
-import socket
-import websocket
+import threading
 import websockets
-from time import sleep
+from time import sleep, time
 from yaml import load, dump, Loader, YAMLError
 
 from arm_commands import ArmCommands
+from reachability import ReachabilityMonitor
+from metrics import REGISTRY, start_http_server, start_pusher
+
+
+HEARTBEAT_SECONDS = REGISTRY.histogram("heartbeat_seconds", "Duration of the heartbeats, including the reachability check and the status report.")
+THREADS = REGISTRY.gauge("threads", "Number of running threads in the process.")
 
 
 class Main:
@@ -19,7 +24,8 @@ class Main:
     Parameters
     ----------
     heart_rate : int
-        Length of interval in seconds in which the connection checks and status reports are executed.
+        Length of interval in seconds in which the connection checks and status reports are executed. While the Cloud service
+        is unreachable, the interval grows with exponential backoff.
     is_dev : bool
         Controls whether the development or production config file should be loaded.
 
@@ -31,15 +37,53 @@ class Main:
         self.load_config()
         self.loop = asyncio.get_event_loop()
         self.control_websocket = None
-        self.commands = ArmCommands(self.config_path)
+        self.control_cloud_host = None
+        self.reachability = ReachabilityMonitor(self.config["cloud_port"], base_delay=heart_rate)
+        self.commands = self.create_commands()
+        self.start_metrics()
+
+    def start_metrics(self):
+        """
+        Starts serving the metrics in the Prometheus format if metrics_port is set in the config file, and pushing a snapshot of them
+        to the Control Panel every metrics_push_interval seconds if it is set.
+
+        """
+
+        THREADS.track(threading.active_count)
+        if self.config.get("metrics_port"):
+            start_http_server(self.config["metrics_port"])
+        if self.config.get("metrics_push_interval"):
+            start_pusher(
+                f"http://{self.config['control_host']}:{self.config['control_port']}/metrics/",
+                self.config["metrics_push_interval"],
+                # Fleets push the metrics of all of their arms in one snapshot
+                self.config.get("arm_id", "fleet")
+            )
+
+    def control_arm_id(self):
+        """
+        Returns the arm_id sent with the requests to the Control Panel which do not concern a single arm.
+
+        """
+
+        return self.config["arm_id"]
+
+    def create_commands(self):
+        """
+        Creates the commands of the arm controlled by this process.
+
+        """
+
+        return ArmCommands(self.config_path)
 
     async def heartbeat(self):
         """
         Heartbeat function, which is executed in a certain interval to check WebSocket connection statuses and set up
-        connections as needed. First, it checks if there is an open and responsive connection to the Cloud service. If not, it will
-        try to open a connection using the host address saved in arm_config.yaml. If the connection cannot be opened, retrieves the
-        Cloud host address from the Control Panel and tries to establish a connection using that. If it succeeds, the new host will
-        be saved to arm_config.yaml. Finally, the connection status is sent to the Control Panel. In case there is a healthy connection
+        connections as needed. First, it checks if the Cloud service is reachable. The host address saved in arm_config.yaml and the
+        latest host retrieved from the Control Panel are probed concurrently, and a successful result is cached for a while, so most
+        heartbeats do not need a handshake at all. If none of the known hosts are reachable, retrieves the Cloud host address from the
+        Control Panel and tries to establish a connection using that. If a host other than the saved one succeeds, it will be saved to
+        arm_config.yaml. Finally, the connection status is sent to the Control Panel. In case there is a healthy connection
         to the Cloud service and the user pressed the start button, a new session will be initiated. If there is no connection, the
         session will not be started even if the start button was pressed.
 
@@ -52,24 +96,79 @@ class Main:
         """
 
         try:
-            cloud_conn_status = self.connect_cloud()
-
-            if not cloud_conn_status:
-                cloud_conn_status = await self.get_cloud_host_and_connect()
+            cloud_conn_status = await self.check_cloud()
 
-            # Report back to Control Panel if connecting to the Cloud Service was successful and see if a new session should be started
-            await self.control_websocket.send(json.dumps({
-                "command": "send_conn_status",
-                "arm_id": self.config["arm_id"],
-                "cloud_conn_status": cloud_conn_status
-            }))
-            should_start_session = json.loads(await self.control_websocket.recv())
-
-            return should_start_session
+            return await self.report_status(self.config["arm_id"], cloud_conn_status)
         except websockets.exceptions.ConnectionClosedError:
             print("WebSockets connection closed.")
             return 0
 
+    async def check_cloud(self):
+        """
+        Checks if the Cloud service is reachable at any of the known hosts, retrieving a new host from the Control Panel if needed.
+
+        Returns
+        -------
+        cloud_conn_status : int
+            0 or 1, representing if the Cloud service is reachable.
+
+        """
+
+        cloud_conn_status, cloud_host = await self.reachability.check([self.config["cloud_host"], self.control_cloud_host])
+
+        if not cloud_conn_status:
+            print("Cloud service is offline.")
+            cloud_conn_status, cloud_host = await self.get_cloud_host_and_connect()
+
+        if cloud_conn_status and cloud_host != self.config["cloud_host"]:
+            self.save_cloud_host(cloud_host)
+
+        return cloud_conn_status
+
+    async def report_status(self, arm_id, cloud_conn_status):
+        """
+        Reports back to Control Panel if connecting to the Cloud Service was successful and sees if a new session should be started.
+        The reply is either a plain integer, or an object with the keys should_start_session and optionally profile, which toggles
+        the profiling of the jobs of the arm.
+
+        Parameters
+        ----------
+        arm_id : str
+            Identifier of the arm whose status is reported.
+        cloud_conn_status : int
+            0 or 1, representing if the Cloud service is reachable.
+
+        Returns
+        -------
+        should_start_session : int
+            0 or 1, representing if the session should be started.
+
+        """
+
+        await self.control_websocket.send(json.dumps({
+            "command": "send_conn_status",
+            "arm_id": arm_id,
+            "cloud_conn_status": cloud_conn_status
+        }))
+
+        reply = json.loads(await self.control_websocket.recv())
+
+        # Control Panels which can toggle profiling reply with an object instead of a plain integer
+        if isinstance(reply, dict):
+            if "profile" in reply:
+                self.set_profiling(arm_id, bool(reply["profile"]))
+            return reply.get("should_start_session", 0)
+
+        return reply
+
+    def set_profiling(self, arm_id, enabled):
+        """
+        Enables or disables the profiling of the jobs of an arm.
+
+        """
+
+        self.commands.profiling = enabled
+
     async def connect_control(self):
         """
         Opens a WebSockets connection to the Control Panel using the address saved in arm_config.yaml. If the connection fails, it will keep
@@ -97,78 +196,56 @@ class Main:
                 print("Control Panel is offline. Retrying in 3s...")
                 sleep(self.heart_rate)
 
-    def connect_cloud(self, cloud_host=None):
-        """
-        Opens a WebSockets connection to the Cloud service.
-
-        Parameters
-        ----------
-        cloud_host : str
-            Optional parameter to specify the host of the connection. If none is provided, the host saved to the config file will be used.
-
-        Returns
-        -------
-        connection_success : int
-            0 or 1, representing if connecting to the Cloud service succeeded. Integer values are used
-            instead of bool, because they are directly JSON serializable.
-
-        """
-        print("cloud_host", cloud_host)
-        self.cloud_url = f"ws://{cloud_host or self.config['cloud_host']}:{self.config['cloud_port']}"
-
-        try:
-            cloud_websocket = websocket.create_connection(self.cloud_url, timeout=1)
-            cloud_websocket.ping()
-            cloud_websocket.close()
-
-            return 1
-        except (
-                ConnectionRefusedError,
-                TimeoutError,
-                ConnectionResetError,
-                socket.timeout,
-                websocket._exceptions.WebSocketConnectionClosedException
-        ):
-            if cloud_host:
-                print("Cloud service is offline with latest host as well.")
-            else:
-                print("Cloud service is offline.")
-
-            return 0
-
     async def get_cloud_host_and_connect(self):
         """
         Retrieves the latest address of the Cloud service from the Control Panel and attempts to connect using the
-        new host. If the connection succeeds, saves the new host to the config file.
+        new host. The retrieved host is remembered, so later heartbeats probe it together with the saved one.
 
         Returns
         -------
         connection_success : int
             0 or 1, representing if the attempted connection using the new host succeeded. Integer values are used
             instead of bool, because they are directly JSON serializable.
+        cloud_host : str
+            The host retrieved from the Control Panel if it is reachable, otherwise None.
 
         """
 
         # Retrieve Cloud host from Control Panel
         await self.control_websocket.send(json.dumps({
             "command": "get_cloud_ip",
-            "arm_id": self.config["arm_id"]
+            "arm_id": self.control_arm_id()
         }))
         new_cloud_host = json.loads(await self.control_websocket.recv())
 
+        # The same hosts were just probed, no need to try them again
+        if new_cloud_host in (self.config["cloud_host"], self.control_cloud_host):
+            return 0, None
+
         # Try to connect to Cloud service with the new host
-        connected_to_new_host = self.connect_cloud(cloud_host=new_cloud_host)
-
-        if connected_to_new_host:
-            # if connection was successful, save new host to config
-            self.config["cloud_host"] = new_cloud_host
-            with open(self.config_path, "w") as outfile:
-                dump(self.config, outfile, default_flow_style=False)
-            # Reload config file to memory here, as this is the only place where it can be changed programmatically
-            self.load_config()
-            return 1
-        else:
-            return 0
+        self.control_cloud_host = new_cloud_host
+        connection_success, cloud_host = await self.reachability.check([new_cloud_host], force=True)
+        if not connection_success:
+            print("Cloud service is offline with latest host as well.")
+
+        return connection_success, cloud_host
+
+    def save_cloud_host(self, cloud_host):
+        """
+        Saves a new host of the Cloud service to the config file.
+
+        Parameters
+        ----------
+        cloud_host : str
+            The host where the Cloud service was reachable.
+
+        """
+
+        self.config["cloud_host"] = cloud_host
+        with open(self.config_path, "w") as outfile:
+            dump(self.config, outfile, default_flow_style=False)
+        # Reload config file to memory here, as this is the only place where it can be changed programmatically
+        self.load_config()
 
     def load_config(self):
         """
@@ -193,13 +270,15 @@ if __name__ == "__main__":
                 main.loop.run_until_complete(main.connect_control())
 
             print("Checking in...")
+            heartbeat_started = time()
             should_start_session = main.loop.run_until_complete(main.heartbeat())
+            HEARTBEAT_SECONDS.observe(time() - heartbeat_started)
             # should_start_session = True
             if should_start_session:
-                main.commands.infer_and_sort()
-                sleep(main.heart_rate)
-            else:
-                sleep(main.heart_rate)
+                main.commands.scheduler.submit("sort", unique=True)
+            sleep(main.reachability.next_delay())
     except KeyboardInterrupt:
+        # Aborts the running session, returns the arm to its start position and neutralizes the servos
+        main.commands.close()
         main.loop.run_until_complete(main.control_websocket.close())
         print("WebSocket connection to Control Panel closed.")
@@ -0,0 +1,310 @@
+"""
+In-process metrics of the arm. Counters, gauges and histograms are registered in a shared registry, which can be served
+in the Prometheus text format on a local HTTP endpoint, and periodically pushed to the Control Panel as a JSON snapshot.
+
+Metrics are created with the functions of the registry, which return the existing metric if it was already registered,
+so modules can declare the metrics they use at import time:
+
+    MOVE_SECONDS = REGISTRY.histogram("servo_move_seconds", "Duration of the moves of a single servo.")
+    MOVE_SECONDS.observe(0.4, servo=0)
+
+"""
+
+import json
+import bisect
+import threading
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTE_BUCKETS = (10000, 50000, 100000, 250000, 500000, 1000000, 2500000, 5000000, 10000000, 50000000)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description):
+        """
+        Base class of the metrics. Every metric keeps a separate value for each combination of label values.
+
+        Parameters
+        ----------
+        name : str
+            Name of the metric in the Prometheus format.
+        description : str
+            Help text of the metric.
+
+        """
+
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def format_labels(self, key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ""
+
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+    def samples(self):
+        """
+        Returns the current values as a list of (label key, value) tuples.
+
+        """
+
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{self.format_labels(key)} {value}" for key, value in self.samples()]
+
+        return lines
+
+    def snapshot(self):
+        return {self.format_labels(key): value for key, value in self.samples()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def track(self, function, **labels):
+        """
+        Registers a function which is called to read the value of the gauge whenever it is collected.
+
+        """
+
+        with self.lock:
+            self.functions[self.key(labels)] = function
+
+    def untrack(self, **labels):
+        """
+        Removes the function registered for the given labels, so the gauge does not keep its owner alive.
+
+        """
+
+        with self.lock:
+            self.functions.pop(self.key(labels), None)
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                # A failing gauge should not break the collection of the other metrics
+                continue
+
+        return list(values.items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0, "count": 0, "max": value}
+            stats = self.values[key]
+            stats["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+            stats["sum"] += value
+            stats["count"] += 1
+            stats["max"] = max(stats["max"], value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the wrapped block in seconds, also if it raises an exception.
+
+        """
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            return [(key, {**stats, "buckets": list(stats["buckets"])}) for key, stats in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, stats in self.samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), stats["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self.format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {stats['sum']}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {stats['count']}")
+
+        return lines
+
+    def snapshot(self):
+        return {
+            self.format_labels(key): {"count": stats["count"], "avg": stats["sum"] / stats["count"], "max": stats["max"]}
+            for key, stats in self.samples()
+        }
+
+
+class Registry:
+    def __init__(self):
+        """
+        Keeps the metrics by name.
+
+        """
+
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric_class, name, *args):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args)
+            elif not isinstance(self.metrics[name], metric_class):
+                raise ValueError(f"Metric {name} is already registered as a {self.metrics[name].kind}.")
+
+            return self.metrics[name]
+
+    def counter(self, name, description):
+        return self.register(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self.register(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, description, buckets)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text format.
+
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def snapshot(self):
+        """
+        Returns a JSON serializable summary of every metric. Histograms are summarized by their count, average and maximum.
+
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port, registry=REGISTRY, host="0.0.0.0"):
+    """
+    Serves the metrics in the Prometheus text format at /metrics in a background thread.
+
+    Parameters
+    ----------
+    port : int
+        Port of the endpoint.
+    registry : Registry
+        Registry to be served.
+    host : str
+        Address to bind to.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        The running server, which can be stopped with shutdown().
+
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.render().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the console otherwise
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+    return server
+
+
+def start_pusher(url, interval, arm_id, registry=REGISTRY, timeout=2):
+    """
+    Posts a snapshot of the metrics to the Control Panel periodically in a background thread. Failed pushes are skipped,
+    the next snapshot contains the same metrics anyway.
+
+    Parameters
+    ----------
+    url : str
+        URL where the snapshots are posted as JSON.
+    interval : float
+        Seconds between two snapshots.
+    arm_id : str
+        Identifier of the arm, or of the fleet, sent along with the snapshot.
+    registry : Registry
+        Registry to be pushed.
+    timeout : float
+        Timeout of a single push in seconds.
+
+    """
+
+    def push():
+        while True:
+            sleep(interval)
+            body = json.dumps({"arm_id": arm_id, "metrics": registry.snapshot()}).encode("utf8")
+            request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+            try:
+                urllib.request.urlopen(request, timeout=timeout).close()
+            except OSError as error:
+                print(f"Pushing metrics failed: {error}")
+
+    threading.Thread(target=push, name="metrics-push", daemon=True).start()
@@ -0,0 +1,310 @@
+"""
+Motion profiles used to generate the trajectories of the servos. A profile plans the fastest move over a given distance which
+respects its limits, and samples it as a list of pulse widths, which are sent to the servo at the step rate of the profile.
+
+The profiles with acceleration limits are symmetric: the servo accelerates to a peak velocity, cruises, then decelerates the same way.
+If the distance is too short to reach the maximum velocity, the peak velocity is lowered, so no time is spent cruising.
+
+    linear       Constant velocity, no ramps. Used for recording the dataset, where even periods between movements are important.
+    sine         Sine ease with a constant average velocity of 700. The default, since its short moves are faster than the limited
+                 profiles with the default limits, at the cost of accelerations far above them.
+    trapezoidal  Constant acceleration ramps. This is the time-optimal move under velocity and acceleration limits.
+    s_curve      Sinusoidal acceleration ramps, so the jerk is limited too. Slightly slower than trapezoidal, but vibrates less.
+
+The limited profiles should only replace sine once the limits of the servos are calibrated, so that typical moves do not get slower.
+
+Run this file directly to compare the durations and peak accelerations of the profiles for typical moves.
+
+"""
+
+import math
+
+
+class MotionProfile:
+    def __init__(self, max_velocity, step_rate=50):
+        """
+        Base class of the motion profiles.
+
+        Parameters
+        ----------
+        max_velocity : float
+            Maximum velocity in pulse width units per second.
+        step_rate : float
+            Number of positions sent to the servo per second. Servos receive pulses at 50 Hz, so higher rates do not make the movement smoother.
+
+        """
+
+        self.max_velocity = max_velocity
+        self.step_rate = step_rate
+
+    def duration(self, distance):
+        """
+        Returns the duration of a move over the given distance in seconds.
+
+        """
+
+        raise NotImplementedError
+
+    def displacement(self, t, distance):
+        """
+        Returns the distance covered at time t of a move over the given distance.
+
+        """
+
+        raise NotImplementedError
+
+    def trajectory(self, start, end):
+        """
+        Samples the move from start to end at the step rate of the profile. The last position is always exactly the end.
+
+        Parameters
+        ----------
+        start : float
+            Start pulse width.
+        end : float
+            End pulse width.
+
+        Returns
+        -------
+        trajectory : list of floats
+            Pulse widths to be sent to the servo, one every 1 / step_rate seconds, excluding the start position.
+
+        """
+
+        distance = abs(end - start)
+        direction = 1 if end >= start else -1
+        n_steps = math.ceil(self.duration(distance) * self.step_rate)
+        if n_steps == 0:
+            return [end]
+
+        trajectory = [start + direction * self.displacement(step / self.step_rate, distance) for step in range(1, n_steps)]
+        trajectory.append(end)
+
+        return trajectory
+
+
+class LinearProfile(MotionProfile):
+    def duration(self, distance):
+        return distance / self.max_velocity
+
+    def displacement(self, t, distance):
+        return min(self.max_velocity * t, distance)
+
+
+class SineProfile(MotionProfile):
+    """
+    Sine ease, where max_velocity is the average velocity of the move. The peak velocity is pi / 2 times higher, and the peak
+    acceleration grows as the move gets shorter.
+
+    """
+
+    def duration(self, distance):
+        return distance / self.max_velocity
+
+    def displacement(self, t, distance):
+        duration = self.duration(distance)
+
+        return distance * (1 - math.cos(math.pi * min(t / duration, 1))) / 2
+
+
+class RampProfile(MotionProfile):
+    def __init__(self, max_velocity, max_acceleration, step_rate=50):
+        """
+        Base class of the symmetric profiles, which accelerate to a peak velocity, cruise, then decelerate.
+
+        Parameters
+        ----------
+        max_velocity : float
+            Maximum velocity in pulse width units per second.
+        max_acceleration : float
+            Maximum acceleration in pulse width units per second squared.
+        step_rate : float
+            Number of positions sent to the servo per second.
+
+        """
+
+        super().__init__(max_velocity, step_rate)
+        self.max_acceleration = max_acceleration
+
+    def peak_velocity(self, distance):
+        """
+        Returns the highest velocity which can be reached, if the servo has to accelerate and decelerate within the distance.
+
+        """
+
+        raise NotImplementedError
+
+    def ramp_time(self, velocity):
+        """
+        Returns the time needed to accelerate from standstill to the given velocity.
+
+        """
+
+        raise NotImplementedError
+
+    def ramp_displacement(self, t, velocity, ramp_time):
+        """
+        Returns the distance covered at time t of accelerating from standstill to the given velocity.
+
+        """
+
+        raise NotImplementedError
+
+    def plan(self, distance):
+        velocity = min(self.max_velocity, self.peak_velocity(distance))
+        ramp_time = self.ramp_time(velocity)
+        # Both ramps together cover velocity * ramp_time, the rest is covered at constant velocity
+        cruise_time = max(distance - velocity * ramp_time, 0) / velocity
+
+        return velocity, ramp_time, cruise_time
+
+    def duration(self, distance):
+        if distance == 0:
+            return 0
+
+        _, ramp_time, cruise_time = self.plan(distance)
+
+        return 2 * ramp_time + cruise_time
+
+    def displacement(self, t, distance):
+        velocity, ramp_time, cruise_time = self.plan(distance)
+        if t <= ramp_time:
+            return self.ramp_displacement(t, velocity, ramp_time)
+        if t <= ramp_time + cruise_time:
+            return velocity * ramp_time / 2 + velocity * (t - ramp_time)
+
+        remaining_time = max(2 * ramp_time + cruise_time - t, 0)
+
+        return distance - self.ramp_displacement(remaining_time, velocity, ramp_time)
+
+
+class TrapezoidalProfile(RampProfile):
+    def peak_velocity(self, distance):
+        return math.sqrt(self.max_acceleration * distance)
+
+    def ramp_time(self, velocity):
+        return velocity / self.max_acceleration
+
+    def ramp_displacement(self, t, velocity, ramp_time):
+        return self.max_acceleration * t ** 2 / 2
+
+
+class SCurveProfile(RampProfile):
+    def __init__(self, max_velocity, max_acceleration, max_jerk, step_rate=50):
+        """
+        Ramps with sinusoidal acceleration, which starts and ends at zero, so the servo is not jerked at the start and end of the ramps.
+        The peak acceleration of a ramp is 2 * velocity / ramp_time, and the peak jerk is 2 * pi * velocity / ramp_time ** 2.
+
+        Parameters
+        ----------
+        max_velocity : float
+            Maximum velocity in pulse width units per second.
+        max_acceleration : float
+            Maximum acceleration in pulse width units per second squared.
+        max_jerk : float
+            Maximum jerk in pulse width units per second cubed.
+        step_rate : float
+            Number of positions sent to the servo per second.
+
+        """
+
+        super().__init__(max_velocity, max_acceleration, step_rate)
+        self.max_jerk = max_jerk
+
+    def peak_velocity(self, distance):
+        # Both ramps together cover velocity * ramp_time, which has to fit in the distance under both the acceleration and jerk limits
+        return min(math.sqrt(self.max_acceleration * distance / 2), (distance ** 2 * self.max_jerk / (2 * math.pi)) ** (1 / 3))
+
+    def ramp_time(self, velocity):
+        return max(2 * velocity / self.max_acceleration, math.sqrt(2 * math.pi * velocity / self.max_jerk))
+
+    def ramp_displacement(self, t, velocity, ramp_time):
+        return velocity * (t ** 2 / (2 * ramp_time) + ramp_time * (math.cos(2 * math.pi * t / ramp_time) - 1) / (4 * math.pi ** 2))
+
+
+PROFILES = {
+    "linear": LinearProfile,
+    "sine": SineProfile,
+    "trapezoidal": TrapezoidalProfile,
+    "s_curve": SCurveProfile
+}
+
+DEFAULT_LIMITS = {"max_velocity": 1100, "max_acceleration": 4000, "max_jerk": 40000}
+# Average velocity of the sine profile, used if max_velocity is not supplied
+SINE_VELOCITY = 700
+
+
+def create_profile(name, step_rate=50, **limits):
+    """
+    Creates a profile by name. Limits which are not used by the profile are ignored, missing ones are taken from DEFAULT_LIMITS,
+    except for the velocity of the sine profile, which defaults to SINE_VELOCITY.
+
+    Parameters
+    ----------
+    name : str
+        One of the keys of PROFILES.
+    step_rate : float
+        Number of positions sent to the servo per second.
+    limits : float
+        Any of max_velocity, max_acceleration and max_jerk.
+
+    Returns
+    -------
+    profile : MotionProfile
+        The created profile.
+
+    """
+
+    if name == "sine":
+        return SineProfile(limits.get("max_velocity", SINE_VELOCITY), step_rate=step_rate)
+
+    limits = {**DEFAULT_LIMITS, **limits}
+    if name == "linear":
+        return LinearProfile(limits["max_velocity"], step_rate=step_rate)
+    if name == "trapezoidal":
+        return TrapezoidalProfile(limits["max_velocity"], limits["max_acceleration"], step_rate=step_rate)
+    if name == "s_curve":
+        return SCurveProfile(limits["max_velocity"], limits["max_acceleration"], limits["max_jerk"], step_rate=step_rate)
+
+    raise ValueError(f"Unknown motion profile: {name}, has to be one of {list(PROFILES)}.")
+
+
+def peak_acceleration(trajectory, step_rate):
+    """
+    Estimates the peak acceleration of a sampled trajectory with second differences.
+
+    """
+
+    accelerations = [(a - 2 * b + c) * step_rate ** 2 for a, b, c in zip(trajectory, trajectory[1:], trajectory[2:])]
+
+    return max(map(abs, accelerations), default=0)
+
+
+def benchmark(distances=(50, 200, 600, 1200)):
+    """
+    Compares the profiles with the default limits. The sine profile runs at SINE_VELOCITY.
+
+    Returns
+    -------
+    results : dict
+        Duration in seconds and estimated peak acceleration for each profile and distance.
+
+    """
+
+    profiles = {name: create_profile(name) for name in PROFILES if name != "linear"}
+
+    results = {}
+    for name, profile in profiles.items():
+        for distance in distances:
+            trajectory = [0] + profile.trajectory(0, distance)
+            results[(name, distance)] = {
+                "duration": len(trajectory[1:]) / profile.step_rate,
+                "peak_acceleration": peak_acceleration(trajectory, profile.step_rate)
+            }
+
+    return results
+
+
+if __name__ == "__main__":
+    for (name, distance), result in benchmark().items():
+        print(f"{name:>12} {distance:>5}: {result['duration']:.2f}s, peak acceleration {result['peak_acceleration']:.0f}")
@@ -0,0 +1,68 @@
+"""
+Verifies locally if an object was picked up, by comparing low resolution frames taken above the object before and after the pick.
+If the object was lifted, the area below the magnet changes, otherwise the two frames are nearly identical.
+
+"""
+
+import numpy as np
+
+
+class PickVerifier:
+    def __init__(self, threshold=12, crop=(0.35, 0.35, 0.65, 0.65)):
+        """
+        Compares the frames of a pick with a vectorized mean absolute difference over the area of the object.
+
+        Parameters
+        ----------
+        threshold : float
+            Minimum mean absolute difference of the grayscale values in the cropped area for the pick to count as successful.
+        crop : tuple
+            Area of the frame where the object is expected, as fractions of the frame size in the format of (left, top, right, bottom).
+
+        """
+
+        self.threshold = threshold
+        self.crop = crop
+
+    def crop_frame(self, frame):
+        height, width = frame.shape[:2]
+        left, top, right, bottom = self.crop
+
+        return frame[int(top * height):int(bottom * height), int(left * width):int(right * width)]
+
+    def difference(self, reference, frame):
+        """
+        Calculates the mean absolute difference of the cropped areas of two frames.
+
+        Parameters
+        ----------
+        reference : numpy.ndarray
+            Grayscale frame taken before the pick.
+        frame : numpy.ndarray
+            Grayscale frame taken after the pick, from the same pose.
+
+        Returns
+        -------
+        difference : float
+            Mean absolute difference of the grayscale values, between 0 and 255.
+
+        """
+
+        return float(np.mean(np.abs(self.crop_frame(reference).astype(np.int16) - self.crop_frame(frame))))
+
+    def verify(self, reference, frame):
+        """
+        Decides if the object was picked up.
+
+        Returns
+        -------
+        picked : bool
+            Boolean representing if the cropped area changed enough for the object to be considered picked up.
+        difference : float
+            Mean absolute difference of the cropped areas, reported to help tuning the threshold.
+
+        """
+
+        difference = self.difference(reference, frame)
+
+        return difference >= self.threshold, difference
@@ -0,0 +1,167 @@
+"""
+Low overhead sampling profiler for diagnosing slow sessions on the Raspberry Pi. A background thread periodically reads the stacks of
+all the other threads with sys._current_frames, and counts how often each stack was seen. The result is written in the collapsed-stack
+format, which can be turned into a flame graph with flamegraph.pl or loaded into speedscope:
+
+    jobs-arm;arm_commands.py:infer_and_sort;servo_control.py:execute_command;[sleep] 153
+
+Every stack starts with the name of the thread, and ends with the category of what the thread was doing, so the time spent
+waiting is visible next to the code that waited. Stacks of the threads of the same pool are merged.
+
+"""
+
+import os
+import re
+import sys
+import linecache
+import threading
+from time import sleep
+
+
+# Modules whose frames mean that the thread is waiting for the network or the disk
+IO_MODULES = ("socket", "ssl", "selectors", "http", "urllib", "websocket", "websockets", "requests", "urllib3", "boto3", "botocore",
+              "s3transfer", "picamera")
+IO_CALLS = re.compile(r"\.(recv|send|send_binary|read|write|capture|upload_file|create_connection|urlopen)\(")
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01, max_depth=40):
+        """
+        Samples the stacks of every thread of the process.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between two samples. The cost of a sample grows with the number of threads and the depth of their stacks,
+            so the interval is a trade-off between overhead and resolution.
+        max_depth : int
+            Maximum number of frames kept from each stack, counted from the innermost one.
+
+        """
+
+        self.interval = interval
+        self.max_depth = max_depth
+        self.counts = {}
+        self.categories = {}
+        self.n_samples = 0
+        self.modules = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            sleep(self.interval)
+
+    def sample(self):
+        """
+        Records the current stack of every thread, except the profiler itself.
+
+        """
+
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+
+            frames = []
+            while frame and len(frames) < self.max_depth:
+                frames.append(frame)
+                frame = frame.f_back
+
+            category = self.classify(frames)
+            # Threads of the same pool are named like ThreadPoolExecutor-0_3, the index of the thread is dropped
+            thread_name = re.sub(r"_\d+$", "", names.get(ident, str(ident)))
+            stack = ";".join([thread_name] + [self.describe(frame) for frame in reversed(frames)] + [f"[{category}]"])
+
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.categories[category] = self.categories.get(category, 0) + 1
+        self.n_samples += 1
+
+    def describe(self, frame):
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+    def classify(self, frames):
+        """
+        Guesses what a thread is doing from its stack. C functions like time.sleep do not have frames, so the innermost Python frame
+        is the one calling them, and its source line tells which one it was.
+
+        Parameters
+        ----------
+        frames : list of frames
+            Frames of the stack, starting with the innermost one.
+
+        Returns
+        -------
+        category : str
+            One of pigpio, sleep, io, wait and cpu.
+
+        """
+
+        if not frames:
+            return "cpu"
+
+        if any(frame.f_code.co_name == "set_servo_pulsewidth" or self.module(frame) == "pigpio" for frame in frames):
+            return "pigpio"
+
+        leaf = frames[0]
+        line = linecache.getline(leaf.f_code.co_filename, leaf.f_lineno)
+        if "sleep(" in line:
+            return "sleep"
+        if self.module(leaf) in IO_MODULES or IO_CALLS.search(line):
+            return "io"
+        if self.module(leaf) in ("threading", "queue") or ".wait(" in line or ".get(" in line or ".acquire(" in line:
+            return "wait"
+
+        return "cpu"
+
+    def module(self, frame):
+        """
+        Returns the top level package of the file of a frame, or the name of the file for top level modules.
+
+        """
+
+        path = frame.f_code.co_filename
+        if path not in self.modules:
+            self.modules[path] = os.path.splitext(os.path.basename(path))[0]
+            for search_path in sorted(sys.path, key=len, reverse=True):
+                if search_path and path.startswith(search_path + os.sep):
+                    self.modules[path] = os.path.relpath(path, search_path).split(os.sep)[0].split(".")[0]
+                    break
+
+        return self.modules[path]
+
+    def summary(self):
+        """
+        Returns the share of the samples in each category, over all the threads.
+
+        """
+
+        total = sum(self.categories.values())
+
+        return {category: count / total for category, count in sorted(self.categories.items())} if total else {}
+
+    def write(self, path):
+        """
+        Writes the sampled stacks in the collapsed-stack format.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file to be written.
+
+        """
+
+        with open(path, "w") as profile_file:
+            for stack, count in sorted(self.counts.items()):
+                profile_file.write(f"{stack} {count}\n")
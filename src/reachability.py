@@ -0,0 +1,134 @@
+"""
+Monitors the reachability of the Cloud service. Probes of the known hosts are executed concurrently in worker threads,
+so they do not block the event loop, and the result is cached for a while to avoid a full handshake on every heartbeat.
+
+"""
+
+import socket
+import random
+import asyncio
+import websocket
+from time import time
+
+
+class ReachabilityMonitor:
+    def __init__(self, port, ttl=15, timeout=1, base_delay=3, max_delay=60):
+        """
+        Keeps a cached reachability status of the Cloud service and calculates the delay until the next heartbeat.
+
+        Parameters
+        ----------
+        port : int
+            Port of the Cloud service.
+        ttl : float
+            Number of seconds for which a successful probe is cached. Failed probes are never cached, the exponential backoff
+            of the heartbeat spaces them out instead.
+        timeout : float
+            Timeout of a single probe in seconds.
+        base_delay : float
+            Delay between heartbeats in seconds while the Cloud service is reachable. This is also the base of the exponential backoff.
+        max_delay : float
+            Upper limit of the delay between heartbeats in seconds while the Cloud service is unreachable.
+
+        """
+
+        self.port = port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.status = 0
+        self.host = None
+        self.checked_at = 0
+        self.failures = 0
+
+    def probe(self, host):
+        """
+        Opens a WebSockets connection to the Cloud service at the given host, sends a ping and closes the connection.
+
+        Parameters
+        ----------
+        host : str
+            Host of the Cloud service to be probed.
+
+        Returns
+        -------
+        connection_success : int
+            0 or 1, representing if connecting to the Cloud service succeeded. Integer values are used
+            instead of bool, because they are directly JSON serializable.
+
+        """
+
+        try:
+            cloud_websocket = websocket.create_connection(f"ws://{host}:{self.port}", timeout=self.timeout)
+            cloud_websocket.ping()
+            cloud_websocket.close()
+
+            return 1
+        except (
+                OSError,
+                socket.timeout,
+                websocket._exceptions.WebSocketException
+        ):
+            return 0
+
+    async def check(self, hosts, force=False):
+        """
+        Returns the cached status if it is still valid, otherwise probes every host concurrently. If multiple hosts are reachable,
+        the one that comes first in the supplied list is preferred.
+
+        Parameters
+        ----------
+        hosts : list of str
+            Candidate hosts of the Cloud service in the order of preference. Empty and duplicate values are ignored.
+        force : bool
+            If true, the cached status is ignored and the hosts are probed again.
+
+        Returns
+        -------
+        status : int
+            0 or 1, representing if the Cloud service is reachable.
+        host : str
+            The host where the Cloud service is reachable, or None if none of the hosts are.
+
+        """
+
+        if not force and self.status and time() - self.checked_at < self.ttl:
+            return self.status, self.host
+
+        hosts = list(dict.fromkeys(host for host in hosts if host))
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(None, self.probe, host) for host in hosts])
+
+        self.checked_at = time()
+        self.host = next((host for host, result in zip(hosts, results) if result), None)
+        self.status = 1 if self.host else 0
+        self.failures = 0 if self.status else self.failures + 1
+
+        return self.status, self.host
+
+    def invalidate(self):
+        """
+        Drops the cached status, for example after a session failed to connect to the Cloud service.
+
+        """
+
+        self.status = 0
+        self.checked_at = 0
+
+    def next_delay(self):
+        """
+        Calculates the delay until the next heartbeat. While the Cloud service is reachable, it is the base delay. After failed probes
+        the delay grows exponentially up to max_delay, with full jitter applied so that multiple arms do not probe in lockstep.
+
+        Returns
+        -------
+        delay : float
+            Number of seconds to wait before the next heartbeat.
+
+        """
+
+        if not self.failures:
+            return self.base_delay
+
+        return random.uniform(self.base_delay, min(self.max_delay, self.base_delay * 2 ** self.failures))
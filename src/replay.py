@@ -0,0 +1,550 @@
+"""
+Records everything a sort session receives from outside, and replays the session on simulated hardware against stand-in servers.
+Since the replayed session gets the same images, the same answers and the same delays, changes to motion planning, pipelining or the
+protocol can be compared on identical inputs.
+
+A recording is a zip archive, saved as session.zip in the session folder when record_sessions is enabled in the config file:
+
+    manifest.json   config of the arm, timing marks of the phases, answers of the Cloud service and the Control Panel
+    captures/       captured images (stored as they are, since JPEG does not compress further) and frames (compressed)
+
+Replay a recording, optionally with changed settings, and print the per-phase deltas:
+
+    python replay.py ../sessions/sess_2020_07_01__10_00_00/session.zip --set motion_profile=trapezoidal --set preposition_arm=true
+
+Settings which need inputs that are not in the recording are refused, like incremental_commands on a session recorded without it,
+since its answers contain no detections, or pick_verification on a session recorded without the frames it needs.
+
+"""
+
+import os
+import json
+import asyncio
+import zipfile
+import argparse
+import tempfile
+import threading
+import websockets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from yaml import dump, safe_load
+
+from stand_in_cloud import StandInCloud
+from simulated_hardware import SimulatedPi, SimulatedGPIO
+
+
+class SessionRecorder:
+    def __init__(self):
+        """
+        Collects the inputs of a session in memory, until they are saved to an archive at the end of the session.
+
+        """
+
+        self.started = monotonic()
+        self.marks = []
+        self.captures = []
+        self.cloud_results = {}
+        self.control_replies = {}
+        self.commands = {"items": [], "done_at": None}
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        return monotonic() - self.started
+
+    def mark(self, name):
+        """
+        Records the end of a phase of the session.
+
+        """
+
+        with self.lock:
+            self.marks.append((name, self.elapsed()))
+
+    def add_capture(self, name, data, duration, is_file):
+        """
+        Records a captured image or frame.
+
+        Parameters
+        ----------
+        name : str
+            Name of the file the image was saved to, or None for frames captured into buffers.
+        data : bytes
+            Content of the image file or the buffer.
+        duration : float
+            Seconds the capture took.
+        is_file : bool
+            Boolean representing if the capture was saved to a file.
+
+        """
+
+        with self.lock:
+            self.captures.append({"name": name, "data": data, "duration": duration, "is_file": is_file})
+
+    def add_cloud_result(self, image_name, is_after, result, latency):
+        """
+        Records the answer of the Cloud service to an image.
+
+        Parameters
+        ----------
+        image_name : str
+            Name of the image.
+        is_after : bool
+            Boolean representing if the image was an after image.
+        result : str or dict
+            Answer to the image, as received by process_result.
+        latency : float
+            Seconds from sending the image until the answer arrived.
+
+        """
+
+        with self.lock:
+            self.cloud_results[result_key(image_name, is_after)] = {"result": result, "latency": latency}
+
+    def add_control_reply(self, name, reply):
+        with self.lock:
+            self.control_replies[name] = reply
+
+    def add_command(self, command, offset):
+        """
+        Records a command received from the Cloud service, with the seconds elapsed since the commands were requested.
+
+        """
+
+        with self.lock:
+            self.commands["items"].append([command, offset])
+
+    def commands_done(self, offset):
+        with self.lock:
+            self.commands["done_at"] = offset
+
+    def save(self, path, config):
+        """
+        Saves the recording to a zip archive.
+
+        Parameters
+        ----------
+        path : str
+            Path of the archive.
+        config : dict
+            Config of the arm during the session.
+
+        """
+
+        with self.lock, zipfile.ZipFile(path, "w") as archive:
+            captures = []
+            for i, capture in enumerate(self.captures):
+                file_name = f"captures/{i:03d}_{capture['name'] or 'frame.yuv'}"
+                # JPEG images do not compress further, raw frames do
+                archive.writestr(file_name, capture["data"], zipfile.ZIP_STORED if capture["is_file"] else zipfile.ZIP_DEFLATED)
+                captures.append({"name": capture["name"], "file": file_name, "duration": capture["duration"], "is_file": capture["is_file"]})
+
+            manifest = {
+                "version": 1,
+                "config": config,
+                "marks": self.marks,
+                "captures": captures,
+                "cloud_results": self.cloud_results,
+                "control_replies": self.control_replies,
+                "commands": self.commands
+            }
+            archive.writestr("manifest.json", json.dumps(manifest), zipfile.ZIP_DEFLATED)
+
+
+def result_key(image_name, is_after):
+    return f"after/{image_name}" if is_after else image_name
+
+
+class RecordingCamera:
+    def __init__(self, camera, recorder):
+        """
+        Wraps a PiCamera-like object, and records every capture of it.
+
+        """
+
+        self.camera = camera
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.camera, name)
+
+    def __setattr__(self, name, value):
+        if name in ("camera", "recorder"):
+            super().__setattr__(name, value)
+        else:
+            setattr(self.camera, name, value)
+
+    def capture(self, output, **kwargs):
+        started = monotonic()
+        self.camera.capture(output, **kwargs)
+        duration = monotonic() - started
+
+        if isinstance(output, str):
+            with open(output, "rb") as image_file:
+                self.recorder.add_capture(os.path.basename(output), image_file.read(), duration, True)
+        else:
+            self.recorder.add_capture(None, bytes(output), duration, False)
+
+
+class ReplayCamera:
+    def __init__(self, archive, captures):
+        """
+        Stands in for PiCamera, and returns the recorded captures in the order they were taken, taking the same time as the originals.
+        Images and frames are served from separate queues, so disabling a feature which captures frames does not shift the images.
+
+        Parameters
+        ----------
+        archive : zipfile.ZipFile
+            Opened archive of the recording.
+        captures : list of dicts
+            Captures listed in the manifest of the recording.
+
+        """
+
+        self.archive = archive
+        self.captures = {is_file: [capture for capture in captures if capture["is_file"] == is_file] for is_file in (True, False)}
+        self.resolution = None
+        self.framerate = None
+        self.recording = False
+        self.n_captures = {True: 0, False: 0}
+        # Captures which were requested, but not recorded
+        self.n_missing = 0
+        self.lock = threading.Lock()
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def capture(self, output, **kwargs):
+        is_file = isinstance(output, str)
+        with self.lock:
+            captures, n_captures = self.captures[is_file], self.n_captures[is_file]
+            capture = captures[n_captures] if n_captures < len(captures) else None
+            self.n_captures[is_file] += 1
+            if not capture:
+                self.n_missing += 1
+            data = self.archive.read(capture["file"]) if capture else b""
+
+        if capture:
+            sleep(capture["duration"])
+        if is_file:
+            with open(output, "wb") as image_file:
+                image_file.write(data)
+        else:
+            # Captures which were not recorded get blank frames, replay reports them as missing
+            output[:] = bytearray(data[:len(output)].ljust(len(output), b"\0"))
+
+    def start_recording(self, output, **kwargs):
+        self.recording = True
+
+    def stop_recording(self):
+        self.recording = False
+
+
+class ReplayCloud(StandInCloud):
+    def __init__(self, cloud_results, commands):
+        """
+        Answers with the recorded results and commands, after the recorded delays, in whichever protocol the replayed session uses.
+        Images that were not recorded, like the after images uploaded after the session, are answered as successful immediately.
+        Answers which the session needed, but which are not in the recording, are collected in missing.
+
+        Parameters
+        ----------
+        cloud_results : dict
+            Recorded answers to the images, keyed by result_key.
+        commands : dict
+            Recorded commands with their offsets from the request.
+
+        """
+
+        super().__init__(n_objects=0, n_containers=0, processing_time=0)
+        self.results = cloud_results
+        self.recorded_commands = commands
+        self.missing = []
+
+    def recorded(self, image_name, is_after, detections=False):
+        recorded = self.results.get(result_key(image_name, is_after))
+        # After images are mostly answered after the recording was saved, so only the images of the scan are required
+        if not is_after and (recorded is None or detections and not isinstance(recorded["result"], dict)):
+            self.missing.append(f"detections of {image_name}" if recorded else f"result of {image_name}")
+
+        return recorded or {"result": True, "latency": 0}
+
+    def as_detections(self, result):
+        if isinstance(result, dict):
+            return result
+
+        return {"success": self.as_success(result), "objects": [], "containers": []}
+
+    def as_success(self, result):
+        if isinstance(result, dict):
+            return result["success"]
+        if isinstance(result, str):
+            try:
+                return json.loads(result)
+            except ValueError:
+                return True
+
+        return result
+
+    async def recv_img(self, websocket, headers):
+        recorded = self.recorded(headers["image_name"], headers["command"] == "recv_img_after", headers.get("return_detections", False))
+        await asyncio.sleep(recorded["latency"])
+
+        if headers.get("return_detections"):
+            await websocket.send(json.dumps(self.as_detections(recorded["result"])))
+        elif isinstance(recorded["result"], str):
+            await websocket.send(recorded["result"])
+        else:
+            await websocket.send(json.dumps(self.as_success(recorded["result"])))
+
+    async def recv_img_batch(self, websocket, headers, payload):
+        recorded = [
+            self.recorded(image["image_name"], headers.get("is_after", False), headers.get("return_detections", False))
+            for image in headers["images"]
+        ]
+        await asyncio.sleep(max(result["latency"] for result in recorded))
+
+        await websocket.send(json.dumps([
+            self.as_detections(result["result"]) if headers.get("return_detections") else {"success": self.as_success(result["result"])}
+            for result in recorded
+        ]))
+
+    async def send_commands(self, websocket, stream):
+        items = self.recorded_commands["items"]
+        if self.recorded_commands["done_at"] is None:
+            self.missing.append("commands")
+        done_at = self.recorded_commands["done_at"] or (items[-1][1] if items else 0)
+
+        if not stream:
+            await asyncio.sleep(done_at)
+            await websocket.send(json.dumps([command for command, _ in items]))
+            return
+
+        elapsed = 0
+        for command, offset in items:
+            await asyncio.sleep(max(offset - elapsed, 0))
+            elapsed = max(offset, elapsed)
+            await websocket.send(json.dumps({"command": command}))
+        await asyncio.sleep(max(done_at - elapsed, 0))
+        await websocket.send(json.dumps({"done": True}))
+
+
+def start_replay_cloud(cloud):
+    """
+    Serves a ReplayCloud on a free local port in a background thread.
+
+    Returns
+    -------
+    port : int
+        Port of the server.
+
+    """
+
+    started = threading.Event()
+    ports = []
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(websockets.serve(cloud.handler, "127.0.0.1", 0))
+        ports.append(server.sockets[0].getsockname()[1])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name="replay-cloud", daemon=True).start()
+    started.wait()
+
+    return ports[0]
+
+
+def start_replay_control(control_replies):
+    """
+    Serves the recorded replies of the Control Panel on a free local port in a background thread. Logs posted to it are dropped.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        The running server.
+
+    """
+
+    class ControlHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.dumps(control_replies["create_session"] if self.path.startswith("/api/sessions/") else {}).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ControlHandler)
+    threading.Thread(target=server.serve_forever, name="replay-control", daemon=True).start()
+
+    return server
+
+
+def phase_durations(marks):
+    """
+    Converts the timing marks of a session to the durations of its phases. Each phase ends with its mark and starts with the previous one.
+
+    """
+
+    durations = {}
+    previous = 0
+    for name, elapsed in marks:
+        durations[name] = elapsed - previous
+        previous = elapsed
+
+    return durations
+
+
+def compare(recorded_marks, replayed_marks):
+    """
+    Calculates the differences between the phases of the recorded and the replayed session.
+
+    Returns
+    -------
+    deltas : dict
+        Recorded and replayed durations and their difference in seconds for each phase, and for the whole session as total.
+
+    """
+
+    recorded, replayed = phase_durations(recorded_marks), phase_durations(replayed_marks)
+    deltas = {}
+    for phase in list(recorded) + [phase for phase in replayed if phase not in recorded]:
+        deltas[phase] = {"recorded": recorded.get(phase), "replayed": replayed.get(phase)}
+    deltas["total"] = {"recorded": recorded_marks[-1][1] if recorded_marks else None, "replayed": replayed_marks[-1][1] if replayed_marks else None}
+
+    for durations in deltas.values():
+        both = durations["recorded"] is not None and durations["replayed"] is not None
+        durations["delta"] = durations["replayed"] - durations["recorded"] if both else None
+
+    return deltas
+
+
+def unrecorded_inputs(manifest, config):
+    """
+    Lists the inputs which a session with the given config needs, but which are not in the recording, so it cannot be replayed
+    meaningfully. Inputs which depend on the course of the session, like the frames of retried picks, are checked after the replay.
+
+    Returns
+    -------
+    missing : list of str
+        Descriptions of the missing inputs.
+
+    """
+
+    recorded = manifest["config"]
+    results = [result["result"] for key, result in manifest["cloud_results"].items() if not key.startswith("after/")]
+    missing = []
+    if config.get("incremental_commands", False) and not any(isinstance(result, dict) for result in results):
+        missing.append("detections of the images, needed by incremental_commands")
+    if not config.get("incremental_commands", False) and manifest["commands"]["done_at"] is None:
+        missing.append("commands of the Cloud service, needed without incremental_commands")
+    for setting, inputs in (("pick_verification", "frames of the picks"), ("after_images", "after images")):
+        if config.get(setting, False) and not recorded.get(setting, False):
+            missing.append(f"{inputs}, needed by {setting}")
+
+    return missing
+
+
+def replay(archive_path, overrides=None):
+    """
+    Replays a recorded session on simulated hardware, against a ReplayCloud and a stand-in Control Panel. The replayed session
+    runs in a temporary storage folder of a replay arm, and is recorded as well, so the phases of the two sessions can be compared.
+
+    Parameters
+    ----------
+    archive_path : str
+        Path of the recording.
+    overrides : dict
+        Settings overriding the recorded config, to try changes on the same inputs.
+
+    Returns
+    -------
+    deltas : dict
+        Recorded and replayed durations of every phase, see compare.
+
+    Raises
+    ------
+    ValueError
+        If the replayed session needs inputs which are not in the recording, see unrecorded_inputs. Since those are answered
+        with blank images and empty results, the deltas would be meaningless.
+
+    """
+
+    # Imported here, because arm_commands imports this module
+    from arm_commands import ArmCommands
+
+    with zipfile.ZipFile(archive_path) as archive, tempfile.TemporaryDirectory(prefix="sorterbot_replay_") as root:
+        manifest = json.loads(archive.read("manifest.json"))
+
+        missing = unrecorded_inputs(manifest, {**manifest["config"], **(overrides or {})})
+        if missing:
+            raise ValueError(f"The recording cannot be replayed with these settings, it does not contain the {'; '.join(missing)}.")
+
+        cloud = ReplayCloud(manifest["cloud_results"], manifest["commands"])
+        cloud_port = start_replay_cloud(cloud)
+        control = start_replay_control(manifest["control_replies"])
+
+        config = {
+            **manifest["config"],
+            **(overrides or {}),
+            "cloud_host": "127.0.0.1",
+            "cloud_port": cloud_port,
+            "control_host": "127.0.0.1",
+            "control_port": control.server_address[1],
+            "record_sessions": True
+        }
+
+        config_path = os.path.join(root, "config.yaml")
+        with open(config_path, "w") as config_file:
+            dump(config, config_file, default_flow_style=False)
+
+        camera = ReplayCamera(archive, manifest["captures"])
+        backends = {"pi": SimulatedPi(), "camera": camera, "gpio": SimulatedGPIO()}
+        # The files of the replayed session, its storage index and its jobs are deleted together with the temporary folder
+        arm = ArmCommands(config_path, arm={"arm_id": f"{config['arm_id']}_REPLAY"}, backends=backends, root=root)
+        try:
+            arm.recorded(arm.infer_and_sort)()
+        finally:
+            arm.close()
+            control.shutdown()
+
+        with zipfile.ZipFile(arm.last_recording) as replayed_archive:
+            replayed_marks = json.loads(replayed_archive.read("manifest.json"))["marks"]
+
+    missing = cloud.missing + ([f"{camera.n_missing} captures"] if camera.n_missing else [])
+    if missing:
+        raise ValueError(f"The replayed session needed inputs which are not in the recording: {', '.join(missing)}.")
+
+    return compare(manifest["marks"], replayed_marks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded SorterBot session on simulated hardware.")
+    parser.add_argument("archive", help="Path of the session.zip of the recorded session.")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a setting of the recorded config.")
+    args = parser.parse_args()
+
+    overrides = {key: safe_load(value) for key, value in (setting.split("=", 1) for setting in args.set)}
+
+    def format_seconds(seconds, sign=""):
+        return "-" if seconds is None else f"{seconds:{sign}.2f}s"
+
+    try:
+        deltas = replay(args.archive, overrides)
+    except ValueError as error:
+        parser.error(str(error))
+
+    for phase, durations in deltas.items():
+        print(
+            f"{phase:>20}: {format_seconds(durations['recorded'])} recorded, {format_seconds(durations['replayed'])} replayed, "
+            f"{format_seconds(durations['delta'], '+')} delta"
+        )
@@ -4,20 +4,38 @@ the high level counterpart, arm_control.
 
 """
 
-import math
-import pigpio
+import bisect
+import threading
 import concurrent.futures
-from time import sleep
+
+from motion_profiles import LinearProfile, create_profile
+from metrics import REGISTRY
+from executors import PoolExecutor
+from time import sleep, monotonic
+
+try:
+    import pigpio
+except ImportError:
+    # Only simulated arms can be used without pigpio
+    pigpio = None
+
+
+MOVE_SECONDS = REGISTRY.histogram("servo_move_seconds", "Duration of the moves of a single servo.")
+SERVO_UPDATES = REGISTRY.counter(
+    "servo_updates_total", "Pulse widths sent and skipped because of the deadband, and commands merged and dropped by coalescing."
+)
 
 
 class ServoControl:
-    def __init__(self, servos=(14, 15, 18, 24, 25), start_positions=(1425, 500, 1800, 1780, 1150)):
+    def __init__(self, servos=(14, 15, 18, 24, 25), start_positions=(1425, 500, 1800, 1780, 1150), pi=None, deadband=3, profile="sine",
+                 limits=None, step_rate=50, executor=None):
         """
         Contains the low level instructions to manipulate the servos using PWM (pulse width modulation). PiGPIO library is used instead of the
         default RPi.GPIO, because PiGPIO uses hardware timing which results in much more accurate pulse widths. Using software timing might delay and alter
         the pulses in case the CPU of the Raspberry Pi is doing some other work in the same time (like uploading a video, etc.).
-        There are different speeds specified in the __init__ function. The units of these are pulse width change per second. A much slower speed is needed
-        for recording the dataset video, since if the arm if moved to fast, the camera will resonate too much and the video will be blurred.
+        Moves are planned by motion profiles, which respect the velocity, acceleration and jerk limits of each servo. The units of these are pulse width
+        change per second (squared, cubed). A much slower linear profile is used for recording the dataset video, since if the arm if moved to fast,
+        the camera will resonate too much and the video will be blurred.
 
         Parameters
         ----------
@@ -33,27 +51,61 @@ class ServoControl:
             it will move counter-clockwise as fast as it can. Usually (depends on the servo), a pulse width of 0.5ms corresponds to the farthest
             it can move counter-clockwise, while 2.5ms corresponds to the farthest clockwise. This means that here the values that correnspond
             to the neutral position of the arm should be suppliad, withing the range of (500, 2500).
+        pi : object
+            Optional object implementing set_servo_pulsewidth, used instead of the connection to the pigpio daemon. Used for simulated arms.
+        deadband : int
+            Pulse width changes smaller than this (in microseconds) do not move the servos, so they are not sent to the pigpio daemon,
+            except for the last position of a trajectory. Every call is a round-trip to the daemon, which competes for CPU with
+            capturing and uploading.
+        profile : str
+            Name of the motion profile used for regular movements, one of the keys of motion_profiles.PROFILES. Defaults to sine,
+            since the limited profiles are slower than it until the limits of the servos are calibrated.
+        limits : list of dicts
+            Optional limits for each servo, with any of the keys max_velocity, max_acceleration and max_jerk. Servos carrying more of the
+            arm should have lower acceleration limits. Missing values are taken from motion_profiles.DEFAULT_LIMITS.
+        step_rate : float
+            Number of positions sent to the servos per second during regular movements.
+        executor : concurrent.futures.Executor
+            Pool executing the commands of parallel movements. It needs one more thread than the number of servos, since background
+            movements, like moving to the staging position, run in the same pool and wait for their own parallel commands.
+            If not supplied, a pool is created for this instance on first use.
 
         """
 
-        self.pi = pigpio.pi()
+        self.pi = pi or pigpio.pi()
         self.servos = servos
         self.start_positions = start_positions
         self.curr_positions = list(self.start_positions)
-        self.speeds = {
-            "dataset": 20,
-            "fast": 700
+        self.deadband = deadband
+        self.last_sent = [None] * len(servos)
+        self.pulse_stats = {"sent": 0, "skipped": 0, "merged": 0, "dropped": 0}
+        self.stats_lock = threading.Lock()
+        self.executor = executor
+        limits = limits or [{}] * len(servos)
+        self.profiles = {
+            # Moves 10 units every 2/3 seconds, giving the camera time to settle between steps
+            "dataset": [LinearProfile(15, step_rate=1.5)] * len(servos),
+            "fast": [create_profile(profile, step_rate=step_rate, **servo_limits) for servo_limits in limits]
         }
 
-    def init_arm_position(self, is_inference=False):
+    def init_arm_position(self, is_inference=False, axis_0_pos=None):
         """
         Instructs the arm to move to inital position for taking a video for training or for taking pictures for inference.
 
+        Parameters
+        ----------
+        is_inference : bool
+            If true, the arm moves to the position for taking pictures for inference, otherwise for recording a training video.
+        axis_0_pos : int
+            Optional pulse width of servo0, overriding the default initial position. Used when the scan does not start at the first step.
+
         """
 
         axis_0_init_pos = 2200
         if is_inference:
             axis_0_init_pos = 2000
+        if axis_0_pos is not None:
+            axis_0_init_pos = axis_0_pos
 
         self.execute_commands(((2, 1810),))
         self.execute_commands((
@@ -63,7 +115,7 @@ class ServoControl:
             (4, self.start_positions[4])
         ), parallel=True)
 
-    def execute_commands(self, commands, parallel=False):
+    def execute_commands(self, commands, parallel=False, trigger=None):
         """
         Executes the commands supplied.
 
@@ -77,19 +129,118 @@ class ServoControl:
             If this parameter is true, the commands are executed simultaneously, utilizing multi-threading. This results in faster and smoother movement,
             but not always applicable. For example after picking up an object, the arm need to move further up to avoid accidentally bumping into other objects
             when moving sideways.
+        trigger : tuple
+            Optional tuple of (fraction, callback), applied to the first command. See execute_command.
 
         """
 
-        if parallel:
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(commands))
-            for cmd in commands:
-                executor.submit(self.execute_command, cmd=cmd)
-            executor.shutdown(wait=True)  # Wait for every thread to complete
+        commands = self.coalesce(commands)
+
+        # If the command carrying the trigger was dropped, its servo is already in position
+        if trigger and (not commands or not commands[0][1]):
+            trigger[1]()
+            trigger = None
+        commands = [cmd for cmd, _ in commands]
+
+        if parallel and len(commands) > 1:
+            if self.executor is None:
+                self.executor = PoolExecutor("motion", len(self.servos) + 1)
+            futures = [self.executor.submit(self.execute_command, cmd=cmd, trigger=trigger if i == 0 else None) for i, cmd in enumerate(commands)]
+            concurrent.futures.wait(futures)  # Wait for every thread to complete
         else:
-            for cmd in commands:
-                self.execute_command(cmd=cmd)
+            for i, cmd in enumerate(commands):
+                self.execute_command(cmd=cmd, trigger=trigger if i == 0 else None)
+
+    def coalesce(self, commands):
+        """
+        Merges consecutive commands of the same servo, keeping only the last one, and drops the commands which would not move their
+        servo, because both the current position and the last sent pulse width are within the deadband of the target. This is typically
+        the case for the commands that fix servos in their current position.
+
+        Parameters
+        ----------
+        commands : tuple
+            Commands as supplied to execute_commands.
+
+        Returns
+        -------
+        commands : list of tuples
+            List of (command, is_first) tuples of the remaining commands, where is_first is true for the command derived from the first
+            supplied command, which carries the trigger.
+
+        """
+
+        merged = []
+        for i, cmd in enumerate(commands):
+            if merged and merged[-1][0][0] == cmd[0]:
+                merged[-1] = (cmd, merged[-1][1])
+                self.count("merged")
+            else:
+                merged.append((cmd, i == 0))
+
+        remaining = []
+        for cmd, is_first in merged:
+            last_sent = self.last_sent[cmd[0]]
+            if last_sent is not None and abs(cmd[1] - self.curr_positions[cmd[0]]) < self.deadband and abs(cmd[1] - last_sent) < self.deadband:
+                self.count("dropped")
+            else:
+                remaining.append((cmd, is_first))
+
+        return remaining
+
+    def set_pulse_width(self, servo_idx, pulse_width, is_final=False):
+        """
+        Sends a pulse width to a servo, unless it is within the deadband of the last sent pulse width. The final position of a trajectory
+        is always sent, unless it rounds to the same microsecond, so the servo ends up exactly at the target.
+
+        Parameters
+        ----------
+        servo_idx : int
+            Index of the servo (not pin number!).
+        pulse_width : float
+            Pulse width in microseconds.
+        is_final : bool
+            Boolean representing if this is the last position of a trajectory.
+
+        """
 
-    def move_to_position(self, end_pos, is_container=False):
+        last_sent = self.last_sent[servo_idx]
+        if last_sent is not None:
+            change = abs(round(pulse_width) - round(last_sent))
+            if change == 0 or (change < self.deadband and not is_final):
+                self.count("skipped")
+                return
+
+        self.pi.set_servo_pulsewidth(self.servos[servo_idx], pulse_width)
+        self.last_sent[servo_idx] = pulse_width
+        self.count("sent")
+
+    def count(self, key):
+        with self.stats_lock:
+            self.pulse_stats[key] += 1
+        SERVO_UPDATES.inc(result=key)
+
+    def stats(self):
+        """
+        Returns the counters of the command layer.
+
+        Returns
+        -------
+        stats : dict
+            Number of pulse widths sent to the pigpio daemon and skipped because of the deadband, number of commands merged into
+            the following command of the same servo and dropped because their servo was already in position, and the ratio of
+            pigpio calls saved by skipping.
+
+        """
+
+        with self.stats_lock:
+            stats = dict(self.pulse_stats)
+        attempted = stats["sent"] + stats["skipped"]
+        stats["saved_ratio"] = stats["skipped"] / attempted if attempted else 0
+
+        return stats
+
+    def move_to_position(self, end_pos, is_container=False, trigger=None):
         """
         Instructs the arm to move to the supplied destination. On the first run, it fixes servo2 and servo3 to avoid unexpected
         movements. It always start with moving servo2 to position in order to avoid bouncing into objects. The variables servo_2_pos and servo_3_pos
@@ -103,6 +254,23 @@ class ServoControl:
             to move to the correct position, and the second element corrensponds to the distance in pixels from the top of the picture used for inference.
         is_container : bool
             If it is true, the arm will move to a higher position, which is suitable for dropping off an object.
+        trigger : tuple
+            Optional tuple of (fraction, callback), which is called when the given fraction of the final descent is completed.
+            Used to switch the magnet before the arm arrives.
+
+        """
+
+        self.move_above_position(end_pos, is_container)
+        self.descend_to_position(end_pos, is_container, trigger)
+
+    def target_pulse_widths(self, end_pos, is_container=False):
+        """
+        Calculates the pulse widths of servo1, servo2 and servo3 at the supplied destination.
+
+        Returns
+        -------
+        pulse_widths : tuple
+            Pulse widths of servo1, servo2 and servo3.
 
         """
 
@@ -112,15 +280,22 @@ class ServoControl:
         servo_2_pos = -7.83e-7 * servo_1_pos ** 3 + 5.26e-3 * servo_1_pos ** 2 - 10.3 * servo_1_pos + 7341 + height_offset
         servo_3_pos = 1.48e-6 * servo_1_pos ** 3 - 8.11e-3 * servo_1_pos ** 2 + 14.2 * servo_1_pos - 6634
 
-        # To fix servos 2 and 3. It only does meaninful things at the first movement after
-        # starting sequence, after that just fixes them on current movement.
-        self.execute_commands((
-            (2, self.curr_positions[2]),
-            (3, self.curr_positions[3])
-        ), parallel=True)
+        return servo_1_pos, servo_2_pos, servo_3_pos
 
+    def move_above_position(self, end_pos, is_container=False):
+        """
+        First half of move_to_position: raises the arm and moves it above the supplied destination.
+
+        """
+
+        servo_1_pos, _, _ = self.target_pulse_widths(end_pos, is_container)
+
+        # To fix servo 3, then raise servo 2. Fixing only does meaninful things at the first movement after starting sequence,
+        # after that the fix of servo 3 is dropped, and the fix of servo 2 is merged into raising it.
         self.execute_commands((
-            (2, self.start_positions[2]),
+            (3, self.curr_positions[3]),
+            (2, self.curr_positions[2]),
+            (2, self.start_positions[2])
         ))
 
         self.execute_commands((
@@ -128,80 +303,157 @@ class ServoControl:
             (0, end_pos[0]),
         ), parallel=True)
 
+    def descend_to_position(self, end_pos, is_container=False, trigger=None):
+        """
+        Second half of move_to_position: lowers the arm from above the supplied destination.
+
+        """
+
+        _, servo_2_pos, servo_3_pos = self.target_pulse_widths(end_pos, is_container)
+
         self.execute_commands((
             (2, servo_2_pos),
             (3, servo_3_pos)
+        ), parallel=True, trigger=trigger)
+
+    def lift_to(self, positions):
+        """
+        Raises the arm back to a pose recorded before descending, first moving servo2 to avoid dragging the object.
+
+        Parameters
+        ----------
+        positions : list
+            Pulse widths of every servo, as in curr_positions.
+
+        """
+
+        self.execute_commands(((2, positions[2]),))
+        self.execute_commands(((3, positions[3]),))
+
+    def sweep(self, servo_idx, end, velocity, marks, on_mark, timeline=None):
+        """
+        Moves a servo to the end position at a constant velocity, and calls on_mark as the servo passes each of the marks, without stopping.
+        Every step is sent regardless of the deadband, and recorded with its time to the timeline, so the position of the servo
+        at any time of the sweep can be interpolated with interpolate_position.
+
+        Parameters
+        ----------
+        servo_idx : int
+            Index of the servo (not pin number!).
+        end : float
+            Pulse width where the sweep ends.
+        velocity : float
+            Velocity of the sweep in pulse width units per second.
+        marks : list of floats
+            Pulse widths where on_mark should be called.
+        on_mark : function
+            Called with the mark, right after the step reaching it was sent.
+        timeline : list
+            Optional list where the (monotonic time, pulse width) tuples of the steps are appended, so they can be read during the sweep.
+
+        Returns
+        -------
+        timeline : list of tuples
+            (monotonic time, pulse width) tuples of the sweep, starting with the start position.
+
+        """
+
+        start = self.curr_positions[servo_idx]
+        direction = 1 if end >= start else -1
+        marks = sorted(marks, key=lambda mark: direction * mark)
+        profile = LinearProfile(velocity, step_rate=self.profiles["fast"][servo_idx].step_rate)
+
+        timeline = timeline if timeline is not None else []
+        next_step_at = monotonic()
+        timeline.append((next_step_at, start))
+        for step in profile.trajectory(start, end):
+            # Steps are usually smaller than the deadband at sweep velocities, but skipping them would make the motion uneven
+            self.set_pulse_width(servo_idx, step, is_final=True)
+            timeline.append((monotonic(), step))
+            self.curr_positions[servo_idx] = step
+            while marks and direction * (step - marks[0]) >= 0:
+                on_mark(marks.pop(0))
+            next_step_at += 1 / profile.step_rate
+            delay = next_step_at - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+        # Marks beyond the end are not reached, but they are still reported, so the caller does not wait for them
+        for mark in marks:
+            on_mark(mark)
+
+        return timeline
+
+    def move_to_staging_position(self, angle, dist):
+        """
+        Moves the arm to a raised staging pose above the given position. Used while waiting for the commands of a session, so that
+        the first pickup starts from a pose which is closer on average than the last scanning position.
+
+        Parameters
+        ----------
+        angle : float
+            Pulse width of servo0 of the staging pose.
+        dist : float
+            Pulse width of servo1 of the staging pose.
+
+        """
+
+        self.execute_commands((
+            (2, self.start_positions[2]),
+        ))
+
+        self.execute_commands((
+            (0, angle),
+            (1, dist - 300)
         ), parallel=True)
 
-    def execute_command(self, cmd):
+    def execute_command(self, cmd, trigger=None):
         """
         Executes a single command on a single servo. Since servos move as fast as they can to the given position,
         which results in a too fast and unstable movement, instead of immediatly giving the command to move to the final positions,
         a series of intermediate positions are generated and supplied to the servo in a certain frequency to slow and smooth the movement.
-        Except when recording the dataset (where even periods between movements are important) a sine smoothing is applied to further
-        slow the movement at the beginning and end of every command. In order the achieve this, first a trajectory is generated as a list
-        of intermediate positions, then the trajectory is executed by sending each position to the servo and pausing for a short time
-        between the steps.
+        Except when recording the dataset (where even periods between movements are important) the motion profile of the servo accelerates
+        and decelerates within its limits at the beginning and end of every command. In order the achieve this, first a trajectory is generated
+        as a list of intermediate positions, then the trajectory is executed by sending each position to the servo and pausing until the next step.
 
         Parameters
         ----------
         cmd : tuple
             Tuple containing the command to be executed. cmd[0] is the servo index (not pin number!), which retrieves the pin number from the
             servos parameter of the __init__ function. cmd[1] is the pulse width where the servo should move, and cmd[2] is optionally the
-            desired speed of the movement. It has to be one of the keys from self.speeds. If nothing is supplied, defaults to "fast".
+            desired speed of the movement. It has to be one of the keys from self.profiles. If nothing is supplied, defaults to "fast".
             Used to slow down movement when recording training video.
+        trigger : tuple
+            Optional tuple of (fraction, callback). The callback is called once, when the given fraction of the trajectory is executed.
 
         """
 
         servo_idx, end = cmd[0], cmd[1]
-        servo = self.servos[servo_idx]
         start = self.curr_positions[servo_idx]
 
-        # Try to get speed from command and default to "fast" if it's not possible. This also determines if this command is doing
-        # dataset recording, since speed is only set explicitly in that case.
-        dataset_recording = False
+        # Try to get the profile from the command and default to "fast" if it's not possible. The profile is only set explicitly
+        # when recording the dataset.
         try:
-            speed = self.speeds[cmd[2]]
-            if cmd[2] == "dataset":
-                dataset_recording = True
+            profile = self.profiles[cmd[2]][servo_idx]
         except IndexError:
-            speed = self.speeds["fast"]
-
-        rotation_units_per_sec = 2 if dataset_recording else 50
-        sleep_length = 1 / 1.5 if dataset_recording else 1 / 50
-
-        delta_angle = end - start
-        duration = delta_angle / speed
-        steps = abs(rotation_units_per_sec * duration)
+            profile = self.profiles["fast"][servo_idx]
 
-        # If start and end are too close to each other, no valid trajectory can be generated, so fix it in starting position.
-        try:
-            delta_angle_per_step = delta_angle / steps
-        except ZeroDivisionError:
-            self.pi.set_servo_pulsewidth(servo, start)
-            return
-
-        # Generate trajectory
-        trajectory = []
-        for step in range(int(steps) + 1):
-            # Calculate movement delta for current step
-            linear_delta = step * delta_angle_per_step
-
-            # Apply sine smoothing
-            sine_delta = math.sin(0.25 * linear_delta * math.pi / (0.25 * delta_angle) - 0.5 * math.pi) * delta_angle / 2 + (delta_angle / 2)
+        trajectory = profile.trajectory(start, end)
+        move_started = monotonic()
 
-            # Calculate end positions for linear and sine smoothed cases
-            linear_value = start + linear_delta
-            sine_value = start + sine_delta
+        # Execute trajectory. Steps are timed from the start of the move, so the time spent sending them does not slow it down.
+        trigger_step = int(trigger[0] * (len(trajectory) - 1)) if trigger else None
+        next_step_at = monotonic()
+        for i, step in enumerate(trajectory):
+            self.set_pulse_width(servo_idx, step, is_final=i == len(trajectory) - 1)
+            if i == trigger_step:
+                trigger[1]()
+            next_step_at += 1 / profile.step_rate
+            delay = next_step_at - monotonic()
+            if delay > 0:
+                sleep(delay)  # Sleep between steps to slow down movement
 
-            # Append the appropriate value depending if a dataset recording is being done or a regular movement
-            trajectory.append(linear_value if dataset_recording else sine_value)
-
-        # Execute trajectory
-        for step in trajectory:
-            self.pi.set_servo_pulsewidth(servo, step)
-            if sleep_length > 0:
-                sleep(sleep_length)  # Sleep between steps to slow down movement
+        MOVE_SECONDS.observe(monotonic() - move_started, servo=servo_idx)
 
         # Update the current position with the last step of the trajectory
         self.curr_positions[servo_idx] = trajectory[-1]
@@ -213,5 +465,36 @@ class ServoControl:
 
         """
 
-        for servo in self.servos:
+        for servo_idx, servo in enumerate(self.servos):
             self.pi.set_servo_pulsewidth(servo, 0)
+            self.last_sent[servo_idx] = None
+
+
+def interpolate_position(timeline, t):
+    """
+    Interpolates the position of a servo at a given time from the timeline of a sweep.
+
+    Parameters
+    ----------
+    timeline : list of tuples
+        (monotonic time, pulse width) tuples in chronological order, as recorded by ServoControl.sweep.
+    t : float
+        Monotonic time. Times outside of the timeline are clamped to its first or last position.
+
+    Returns
+    -------
+    position : float
+        Interpolated pulse width.
+
+    """
+
+    times = [step_time for step_time, _ in timeline]
+    i = bisect.bisect_right(times, t)
+    if i == 0:
+        return timeline[0][1]
+    if i == len(timeline):
+        return timeline[-1][1]
+
+    (t0, p0), (t1, p1) = timeline[i - 1], timeline[i]
+
+    return p0 + (p1 - p0) * (t - t0) / (t1 - t0) if t1 > t0 else p1
@@ -0,0 +1,156 @@
+"""
+Keeps track of the objects and containers detected during a session, as the per-image results arrive from the Cloud service.
+Used by the incremental command protocol to start sorting before every image of the session has been processed.
+
+"""
+
+import threading
+from time import monotonic
+
+
+class SessionMap:
+    def __init__(self, steps, fov_as_pw=670, tolerance_as_pw=60, result_timeout=120):
+        """
+        Collects per-image detection results and decides which commands can already be executed. An area of the scanned region
+        is considered final when none of the images that are still being processed cover it, since those images could still
+        contain new objects or better estimates of the positions of known objects in that area.
+
+        Parameters
+        ----------
+        steps : list of ints
+            List containing pulse widths of servo 0 where images were taken. Each of them is pending until its result arrives.
+        fov_as_pw : int
+            Horizontal field of view of the camera expressed as servo 0 pulse width. An image taken at a given step covers the
+            range of (step - fov_as_pw / 2, step + fov_as_pw / 2).
+        tolerance_as_pw : int
+            Maximum difference in both polar coordinates for which two detections are considered to be the same object.
+        result_timeout : float
+            Seconds to wait for the results of the images. Images which are still pending after this are registered as failed,
+            so a lost answer cannot block the session forever.
+
+        """
+
+        self.pending = set(steps)
+        self.result_timeout = result_timeout
+        self.half_fov = fov_as_pw / 2
+        self.tolerance = tolerance_as_pw
+        self.objects = []
+        self.containers = {}
+        self.failed = []
+        self.condition = threading.Condition()
+
+    def add_result(self, step, success, objects=(), containers=()):
+        """
+        Registers the result of an image and wakes up the thread waiting for commands.
+
+        Parameters
+        ----------
+        step : int
+            Identifies the image, corresponds to the pulse width of servo 0 where the image was taken.
+        success : bool
+            Boolean representing if image processing was successful. Failed images are marked as finished without detections.
+        objects : list of dicts
+            Detected objects, each of them in the format of {"pos": [angle_as_pw, dist_as_pw], "cluster": int}.
+        containers : list of dicts
+            Detected containers, each of them in the format of {"pos": [angle_as_pw, dist_as_pw], "cluster": int}.
+
+        """
+
+        with self.condition:
+            self.pending.discard(step)
+
+            if success:
+                for obj in objects:
+                    self.merge(self.objects, obj)
+                for cont in containers:
+                    if cont["cluster"] in self.containers:
+                        self.average(self.containers[cont["cluster"]], cont["pos"])
+                    else:
+                        self.containers[cont["cluster"]] = {"pos": list(cont["pos"]), "n": 1}
+            else:
+                self.failed.append(step)
+
+            self.condition.notify_all()
+
+    def merge(self, known_objects, obj):
+        """
+        Merges a detection into the list of known objects. If an object within tolerance already exists, its position is updated
+        with the running average of the detections, otherwise the detection is appended as a new object.
+
+        """
+
+        for known in known_objects:
+            if known["cluster"] == obj["cluster"] and all(abs(k - o) <= self.tolerance for k, o in zip(known["pos"], obj["pos"])):
+                # Objects which are already being moved are not updated anymore, but still absorb duplicate detections
+                if not known["done"]:
+                    self.average(known, obj["pos"])
+                return
+
+        known_objects.append({"pos": list(obj["pos"]), "cluster": obj["cluster"], "n": 1, "done": False})
+
+    def average(self, known, pos):
+        """
+        Updates the position of a known object or container with the running average of its detections.
+
+        """
+
+        known["pos"] = [(k * known["n"] + p) / (known["n"] + 1) for k, p in zip(known["pos"], pos)]
+        known["n"] += 1
+
+    def is_final(self, pos):
+        """
+        Checks if a position is outside of the area covered by every pending image.
+
+        """
+
+        return all(abs(pos[0] - step) > self.half_fov for step in self.pending)
+
+    def pop_ready_commands(self):
+        """
+        Collects the commands which can be executed: the object's area is final and the container of its cluster is known and final.
+        The returned objects are marked as done, so they will not be returned again.
+
+        Returns
+        -------
+        commands : list
+            List of commands, each of them containing the object's and the container's polar coordinates.
+
+        """
+
+        commands = []
+        for obj in self.objects:
+            container = self.containers.get(obj["cluster"])
+            if obj["done"] or not container or not self.is_final(obj["pos"]) or not self.is_final(container["pos"]):
+                continue
+            obj["done"] = True
+            commands.append([obj["pos"], container["pos"]])
+
+        return commands
+
+    def iter_commands(self):
+        """
+        Yields commands as soon as they become ready, blocking while waiting for further results. Returns when every image
+        has been processed and all the commands are yielded. If the results do not arrive within result_timeout seconds,
+        the pending images are registered as failed.
+
+        Yields
+        ------
+        command : list
+            List containing the object's and the container's polar coordinates.
+
+        """
+
+        deadline = monotonic() + self.result_timeout
+        while True:
+            with self.condition:
+                commands = self.pop_ready_commands()
+                while not commands and self.pending:
+                    if not self.condition.wait(max(deadline - monotonic(), 0)):
+                        self.failed.extend(sorted(self.pending))
+                        self.pending.clear()
+                    commands = self.pop_ready_commands()
+
+            if not commands:
+                return
+
+            yield from commands
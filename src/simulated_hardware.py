@@ -0,0 +1,114 @@
+"""
+Simulated replacements of the hardware libraries (pigpio, PiCamera and RPi.GPIO), which can be passed to ArmCommands as backends.
+They implement only the subset of the interfaces used by this project, and count the calls, so benchmarks can run without an arm.
+
+"""
+
+import os
+import threading
+from time import sleep
+
+
+class SimulatedPi:
+    def __init__(self):
+        """
+        Stands in for the connection to the pigpio daemon. Keeps the last pulse width of every pin.
+
+        """
+
+        self.pulse_widths = {}
+        self.n_calls = 0
+        self.lock = threading.Lock()
+
+    def set_servo_pulsewidth(self, pin, pulse_width):
+        with self.lock:
+            self.pulse_widths[pin] = pulse_width
+            self.n_calls += 1
+
+    def get_servo_pulsewidth(self, pin):
+        return self.pulse_widths.get(pin, 0)
+
+
+class SimulatedCamera:
+    def __init__(self, capture_time=0.05, image_size=200000):
+        """
+        Stands in for PiCamera. Captured images are random bytes of the given size, frames captured into buffers are random noise.
+
+        Parameters
+        ----------
+        capture_time : float
+            Seconds a capture takes.
+        image_size : int
+            Size of the written images in bytes.
+
+        """
+
+        self.capture_time = capture_time
+        self.image_size = image_size
+        self.resolution = None
+        self.framerate = None
+        self.recording = False
+        self.n_captures = 0
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def capture(self, output, **kwargs):
+        sleep(self.capture_time)
+        if isinstance(output, str):
+            with open(output, "wb") as image_file:
+                image_file.write(os.urandom(self.image_size))
+        else:
+            # Frames captured into buffers are filled in place, like the YUV captures of PiCamera
+            output[:] = bytearray(os.urandom(len(output)))
+        self.n_captures += 1
+
+    def start_recording(self, output, **kwargs):
+        self.recording = True
+
+    def stop_recording(self):
+        self.recording = False
+
+
+class SimulatedGPIO:
+    """
+    Stands in for the RPi.GPIO module. Keeps the last output value of every pin.
+
+    """
+
+    BCM = "BCM"
+    OUT = "OUT"
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.outputs = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, mode):
+        self.outputs[pin] = self.LOW
+
+    def output(self, pin, value):
+        self.outputs[pin] = value
+
+
+def create_backends():
+    """
+    Creates a new set of simulated backends for a single arm.
+
+    Returns
+    -------
+    backends : dict
+        Simulated backends with the keys expected by ArmCommands.
+
+    """
+
+    return {"pi": SimulatedPi(), "camera": SimulatedCamera(), "gpio": SimulatedGPIO()}
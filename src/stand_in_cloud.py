@@ -0,0 +1,132 @@
+"""
+Local stand-in for the Cloud service, which can be used to test the Raspberry side without deploying the inference engine.
+Instead of running inference, it generates a random scene of objects and containers, and replies with the detections that would be
+visible on each image. Start it with `python stand_in_cloud.py` and point cloud_host and cloud_port in arm_config.yaml to it.
+
+"""
+
+import json
+import random
+import asyncio
+import argparse
+import websockets
+
+from framing import decode_message, split_batch
+
+
+class StandInCloud:
+    def __init__(self, n_objects=8, n_containers=2, fov_as_pw=670, noise_as_pw=10, processing_time=0.5, seed=None):
+        """
+        Generates a random scene and serves the commands used by the Raspberry over WebSockets.
+
+        Parameters
+        ----------
+        n_objects : int
+            Number of objects in the generated scene.
+        n_containers : int
+            Number of containers in the generated scene. Each object belongs to one of the containers.
+        fov_as_pw : int
+            Horizontal field of view of the camera expressed as servo 0 pulse width, used to decide which items are visible on an image.
+        noise_as_pw : int
+            Maximum random error added to the positions of the detections.
+        processing_time : float
+            Seconds to wait before replying to an image, to simulate inference.
+        seed : int
+            Seed of the random number generator, used to generate the same scene on every run.
+
+        """
+
+        self.random = random.Random(seed)
+        self.half_fov = fov_as_pw / 2
+        self.noise = noise_as_pw
+        self.processing_time = processing_time
+        self.containers = [{"pos": self.random_position(), "cluster": cluster} for cluster in range(n_containers)]
+        self.objects = [{"pos": self.random_position(), "cluster": self.random.randrange(n_containers)} for _ in range(n_objects)]
+
+    def random_position(self):
+        return [self.random.uniform(1000, 1800), self.random.uniform(1100, 2000)]
+
+    def detections(self, step, items):
+        """
+        Returns the items visible on the image taken at step with random noise added to their positions.
+
+        """
+
+        return [{
+            "pos": [coord + self.random.uniform(-self.noise, self.noise) for coord in item["pos"]],
+            "cluster": item["cluster"]
+        } for item in items if abs(item["pos"][0] - step) <= self.half_fov]
+
+    def commands(self):
+        return [[obj["pos"], self.containers[obj["cluster"]]["pos"]] for obj in self.objects]
+
+    async def handler(self, websocket, path=None):
+        """
+        Handles a single connection from the Raspberry. Images arrive as binary messages, everything else as JSON.
+
+        """
+
+        async for message in websocket:
+            if isinstance(message, bytes):
+                headers, payload = decode_message(message)
+                if headers["command"] == "recv_img_batch":
+                    await self.recv_img_batch(websocket, headers, payload)
+                else:
+                    await self.recv_img(websocket, headers)
+                continue
+
+            message = json.loads(message)
+            if message["command"] == "get_commands_of_session":
+                await self.send_commands(websocket, message.get("stream", False))
+            elif message["command"] == "stitch_after_image":
+                print(f"Stitching after image of session {message['session_id']}.")
+
+    async def recv_img(self, websocket, headers):
+        await asyncio.sleep(self.processing_time)
+
+        if not headers.get("return_detections"):
+            await websocket.send(json.dumps(True))
+            return
+
+        await websocket.send(json.dumps(self.image_result(headers["image_name"])))
+
+    async def recv_img_batch(self, websocket, headers, payload):
+        images = split_batch(headers, payload)
+        await asyncio.sleep(self.processing_time * len(images))
+
+        await websocket.send(json.dumps([
+            self.image_result(image["image_name"]) if headers.get("return_detections") else {"success": True}
+            for image, _ in images
+        ]))
+
+    def image_result(self, image_name):
+        step = int(image_name.split(".")[0])
+
+        return {
+            "success": True,
+            "objects": self.detections(step, self.objects),
+            "containers": self.detections(step, self.containers)
+        }
+
+    async def send_commands(self, websocket, stream):
+        if not stream:
+            await websocket.send(json.dumps(self.commands()))
+            return
+
+        for command in self.commands():
+            await websocket.send(json.dumps({"command": command}))
+        await websocket.send(json.dumps({"done": True}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the SorterBot Cloud service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    cloud = StandInCloud(seed=args.seed)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(websockets.serve(cloud.handler, args.host, args.port))
+    print(f"Stand-in Cloud service listening on ws://{args.host}:{args.port}")
+    loop.run_forever()
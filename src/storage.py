@@ -1,23 +1,83 @@
 """
-Handles uploads to AWS s3 and creation of local folder for files to be saved.
+Handles uploads to AWS s3 and creation of local folder for files to be saved. Keeps a small index of the saved artifacts,
+so the next folder can be found without scanning the disk, and old artifacts can be evicted before the SD card fills up.
 
 """
 
 import os
 import re
+import json
+import shutil
 import boto3
+import threading
 from datetime import datetime
 from pathlib import Path
+from time import time
+
+from metrics import REGISTRY, BYTE_BUCKETS
+
+
+UPLOAD_BYTES = REGISTRY.histogram("upload_bytes", "Size of the uploaded files and images.", BYTE_BUCKETS)
+UPLOAD_SECONDS = REGISTRY.histogram("upload_seconds", "Duration of the uploads, excluding the handshakes.")
+STORAGE_BYTES = REGISTRY.gauge("storage_bytes", "Total size of the artifacts tracked in the storage index, see Storage.total_size.")
 
 
 class Storage:
-    def __init__(self):
+    def __init__(self, subfolder="", quota_mb=None, max_age_days=None, evict_unuploaded=False, root=None):
         """
         Includes methods for upload to s3 and creation of folders.
+
+        Parameters
+        ----------
+        subfolder : str
+            Optional name of a folder inside sessions and recordings, used to separate the files of the arms of a fleet.
+        quota_mb : float
+            Maximum total size of the tracked artifacts in megabytes. If exceeded, the oldest uploaded artifacts are deleted. No limit if None.
+        max_age_days : float
+            Uploaded artifacts older than this are deleted. No limit if None.
+        evict_unuploaded : bool
+            If true, artifacts which were not uploaded are also deleted when the quota is exceeded, after all the uploaded ones.
+        root : str
+            Folder containing the sessions and recordings folders and the index. Defaults to the root of the project.
+
         """
         self.s3 = boto3.resource("s3")
+        self.subfolder = subfolder
+        self.quota = quota_mb * 1024 * 1024 if quota_mb else None
+        self.max_age = max_age_days * 24 * 3600 if max_age_days else None
+        self.evict_unuploaded = evict_unuploaded
+
+        self.root = Path(root) if root else Path(__file__).resolve().parent.parent
+        self.index_path = os.path.join(self.root, f"storage_index{'_' + subfolder if subfolder else ''}.json")
+        self.lock = threading.Lock()
+        self.train_folder = None
+        self.load_index()
+        STORAGE_BYTES.track(self.total_size, subfolder=subfolder)
+
+    def load_index(self):
+        """
+        Loads the index of the artifacts. If it does not exist or it is corrupted, a new one is started.
+
+        """
+
+        try:
+            with open(self.index_path, "r") as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {"train_folder": None, "artifacts": {}}
 
-    def upload_file(self, bucket, path, arm_id=""):
+    def save_index(self):
+        """
+        Saves the index atomically, so a power loss cannot leave a partially written file behind. Has to be called while holding the lock.
+
+        """
+
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def upload_file(self, bucket, path, arm_id="", callback=None):
         """
         Uploads a file to s3.
 
@@ -29,14 +89,24 @@ class Storage:
             Path of the file to be uploaded.
         arm_id : str
             Identifier of the arm.
+        callback : function
+            Optional function called periodically during the upload with the number of bytes transferred since the previous call.
 
         """
 
         filename = os.path.basename(path)
+        # Files deleted by retention, or uploaded before a restart interrupted the job, are done
+        if not os.path.exists(path):
+            print(f"{filename} no longer exists, skipping upload.")
+            return
+
         print(f"Uploading {filename}...")
         dir_tree = os.path.dirname(path)
         parent_folder = os.path.basename(dir_tree)
-        self.s3.Bucket(bucket).upload_file(path, os.path.join(arm_id, parent_folder, filename))
+        with UPLOAD_SECONDS.time(target="s3"):
+            self.s3.Bucket(bucket).upload_file(path, os.path.join(arm_id, parent_folder, filename), Callback=callback)
+        UPLOAD_BYTES.observe(os.path.getsize(path), target="s3")
+        self.mark_uploaded(path)
         print(f"Upload of {filename} completed!")
 
     def create_next_session_folder(self):
@@ -50,17 +120,19 @@ class Storage:
 
         """
 
-        sessions_path = os.path.join(Path(__file__).resolve().parent.parent, "sessions")
+        sessions_path = os.path.join(self.root, "sessions", self.subfolder)
         curr_sess_path = os.path.join(sessions_path, f"sess_{datetime.now().strftime('%Y_%m_%d__%H_%M_%S')}")
         os.makedirs(curr_sess_path, exist_ok=True)
+        self.track(curr_sess_path)
 
         return curr_sess_path
 
     def create_next_train_folder(self):
         """
         Creates a folder for the training videos, named as simple integers starting from 1.
-        It will find the highest existing number and increment it to get the current folder name.
-        If the highest number is an empty folder, that will be used instead of creating a new one.
+        The number of the last folder is read from the index. If that folder is empty and nothing was saved to it, it will be used
+        instead of creating a new one. A folder emptied by retention is not reused, since its set is already uploaded.
+        The recordings folder is only scanned if the index does not contain the number yet.
 
         Returns
         -------
@@ -69,33 +141,235 @@ class Storage:
 
         """
 
-        recordings_path = os.path.join(Path(__file__).resolve().parent.parent, "recordings")
+        recordings_path = os.path.join(self.root, "recordings", self.subfolder)
+
+        with self.lock:
+            last_number = self.index["train_folder"]
+            if last_number is None:
+                last_number = self.find_last_train_folder(recordings_path)
+
+            last_folder = os.path.join(recordings_path, str(last_number))
+            is_unused = not self.index.get("train_folder_used", False)
+            if last_number and is_unused and os.path.isdir(last_folder) and len(os.listdir(last_folder)) == 0:
+                next_number = last_number
+            else:
+                next_number = last_number + 1
+
+            next_folder = os.path.join(recordings_path, str(next_number))
+            os.makedirs(next_folder, exist_ok=True)
+
+            self.index["train_folder"] = next_number
+            self.index["train_folder_used"] = False
+            self.train_folder = os.path.abspath(next_folder)
+            self.save_index()
+
+        return next_folder
+
+    def find_last_train_folder(self, recordings_path):
+        """
+        Finds the highest numbered folder in recordings. Only used when the index does not contain it yet.
+
+        Returns
+        -------
+        last_number : int
+            Number of the last folder, or 0 if there are no folders yet.
+
+        """
 
-        # List subfolders in recordings folder or create it in case it does not exist
         try:
-            folder_names = [f.name for f in os.scandir(recordings_path) if f.is_dir()]
+            numbers = [int(f.name) for f in os.scandir(recordings_path) if f.is_dir() and re.fullmatch("[0-9]+", f.name)]
         except FileNotFoundError:
-            folder_names = []
-            os.makedirs(recordings_path)
-            next_folder = os.path.join(recordings_path, "1")
-
-        # Nauturally sort folder names
-        def sorted_alphanumeric(data):
-            convert = lambda text: int(text) if text.isdigit() else text.lower()
-            alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
-            return sorted(data, key=alphanum_key)
-        folder_names = sorted_alphanumeric(folder_names)
-
-        # Check if there are any folders in recordings and initialize a folder with number 1 if not
-        try:
-            next_folder = os.path.join(recordings_path, folder_names[-1])
-        except IndexError:
-            next_folder = os.path.join(recordings_path, "1")
-            os.makedirs(next_folder)
+            numbers = []
 
-        # Check if last folder contains any items and create new folder if it does
-        if len(os.listdir(next_folder)) != 0:
-            next_folder = os.path.join(recordings_path, str(int(folder_names[-1]) + 1))
-            os.makedirs(next_folder)
+        return max(numbers, default=0)
 
-        return next_folder
+    def track(self, path, uploaded=False):
+        """
+        Adds a file or folder to the index, so it is considered by the retention rules.
+
+        Parameters
+        ----------
+        path : str
+            Path of the artifact.
+        uploaded : bool
+            Boolean representing if the artifact is already uploaded, so it can be deleted locally.
+
+        """
+
+        with self.lock:
+            self.index["artifacts"][os.path.relpath(path, self.root)] = {
+                "size": self.size_of(path),
+                "created_at": time(),
+                "uploaded": uploaded
+            }
+            # The folder of the training set cannot be reused once anything was saved to it, even if retention empties it later
+            if os.path.dirname(os.path.abspath(path)) == self.train_folder:
+                self.index["train_folder_used"] = True
+            self.save_index()
+
+    def mark_uploaded(self, path):
+        """
+        Marks an artifact as uploaded, if it is tracked.
+
+        """
+
+        with self.lock:
+            artifact = self.index["artifacts"].get(os.path.relpath(path, self.root))
+            if artifact:
+                artifact["uploaded"] = True
+                self.save_index()
+
+    def finish_session(self, path):
+        """
+        Updates the index after a session. Successfully processed images are deleted during the session, so if no image is left,
+        the folder is deleted and the session counts as uploaded. Otherwise the size of the remaining images is recorded.
+
+        Parameters
+        ----------
+        path : str
+            Path of the session folder.
+
+        """
+
+        self.remove_empty_folders(path)
+        with self.lock:
+            key = os.path.relpath(path, self.root)
+            if not os.path.exists(path):
+                self.index["artifacts"].pop(key, None)
+            elif key in self.index["artifacts"]:
+                self.index["artifacts"][key]["size"] = self.size_of(path)
+            self.save_index()
+
+    def enforce_retention(self):
+        """
+        Deletes uploaded artifacts older than max_age_days, then deletes the oldest uploaded artifacts until the total size is within
+        the quota. If evict_unuploaded is true, the oldest artifacts which were not uploaded are deleted next, if still needed.
+        Artifacts inside a tracked folder, like the session.zip of a session, count towards the quota only once, as part of the folder.
+        Artifacts which no longer exist are dropped from the index.
+
+        Returns
+        -------
+        evicted : list of str
+            Paths of the deleted artifacts relative to the root of the project.
+
+        """
+
+        evicted = []
+        with self.lock:
+            artifacts = self.index["artifacts"]
+
+            # Sizes change as the images of finished sessions are uploaded in the background, so they are refreshed here
+            for key in list(artifacts):
+                path = os.path.join(self.root, key)
+                self.remove_empty_folders(path)
+                if not os.path.exists(path):
+                    artifacts.pop(key)
+                else:
+                    artifacts[key]["size"] = self.size_of(path)
+
+            by_age = sorted(artifacts, key=lambda key: artifacts[key]["created_at"])
+            parents = {key: self.parent_of(key, artifacts) for key in artifacts}
+
+            if self.max_age:
+                evicted += [key for key in by_age if artifacts[key]["uploaded"] and time() - artifacts[key]["created_at"] > self.max_age]
+
+            if self.quota:
+                candidates = [key for key in by_age if artifacts[key]["uploaded"]]
+                if self.evict_unuploaded:
+                    candidates += [key for key in by_age if not artifacts[key]["uploaded"]]
+                for key in candidates:
+                    if self.retained_size(artifacts, parents, evicted) <= self.quota:
+                        break
+                    if key not in evicted and parents[key] not in evicted:
+                        evicted.append(key)
+
+            for key in evicted:
+                self.delete(os.path.join(self.root, key))
+                artifacts.pop(key)
+
+            # Artifacts inside deleted folders are gone as well, while folders which lost an artifact shrank
+            for key in list(artifacts):
+                if parents[key] in evicted:
+                    artifacts.pop(key)
+                elif any(parents[other] == key for other in evicted):
+                    path = os.path.join(self.root, key)
+                    self.remove_empty_folders(path)
+                    if not os.path.exists(path):
+                        artifacts.pop(key)
+                    else:
+                        artifacts[key]["size"] = self.size_of(path)
+
+            self.save_index()
+
+        return evicted
+
+    def total_size(self):
+        """
+        Returns the total size of the tracked artifacts in bytes, counting the artifacts inside tracked folders only once,
+        the same way as retention does.
+
+        """
+
+        with self.lock:
+            artifacts = dict(self.index["artifacts"])
+
+        parents = {key: self.parent_of(key, artifacts) for key in artifacts}
+
+        return self.retained_size(artifacts, parents, [])
+
+    def parent_of(self, key, artifacts):
+        """
+        Returns the key of the tracked folder containing an artifact, like the session folder of its session.zip, or None.
+
+        """
+
+        return min((other for other in artifacts if key.startswith(other + os.sep)), key=len, default=None)
+
+    def retained_size(self, artifacts, parents, evicted):
+        """
+        Returns the total size of the artifacts which are not evicted. The size of a folder includes the artifacts tracked
+        inside it, so those are only subtracted from it if they are evicted on their own, and are not counted again.
+
+        """
+
+        total = 0
+        for key, artifact in artifacts.items():
+            if key in evicted or parents[key] in evicted:
+                continue
+            if parents[key] is None:
+                total += artifact["size"]
+
+        # Evicted artifacts inside a retained folder still count in the size of the folder
+        total -= sum(artifacts[key]["size"] for key in evicted if parents[key] is not None and parents[key] not in evicted)
+
+        return total
+
+    def size_of(self, path):
+        """
+        Returns the size of a file, or the total size of the files in a folder, in bytes.
+
+        """
+
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+
+        return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+
+    def remove_empty_folders(self, path):
+        """
+        Deletes a folder if it contains no files, including its empty subfolders.
+
+        """
+
+        if not os.path.isdir(path):
+            return
+
+        for folder, _, _ in sorted(os.walk(path), key=lambda walked: len(walked[0]), reverse=True):
+            if not os.listdir(folder):
+                os.rmdir(folder)
+
+    def delete(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
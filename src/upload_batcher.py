@@ -0,0 +1,85 @@
+"""
+Decides how many images should be packed into a single upload message, based on the measured bandwidth and round-trip time
+of the connection to the Cloud service.
+
+"""
+
+import math
+import threading
+
+
+class UploadBatcher:
+    def __init__(self, max_batch_size=5, overhead_ratio=0.2, smoothing=0.3, image_size=500000):
+        """
+        Keeps exponentially weighted moving averages of the bandwidth and the round-trip time of the uploads. On links with high latency
+        compared to the transfer time of an image, the per-message overhead dominates, so more images are packed into a message.
+
+        Parameters
+        ----------
+        max_batch_size : int
+            Upper limit of the number of images in a batch. Larger batches delay the processing of the first images of the batch.
+        overhead_ratio : float
+            Targeted maximum ratio of the round-trip time and the transfer time of a batch.
+        smoothing : float
+            Weight of the latest measurement in the moving averages.
+        image_size : int
+            Size of an image in bytes used before the first measurement.
+
+        """
+
+        self.max_batch_size = max_batch_size
+        self.overhead_ratio = overhead_ratio
+        self.smoothing = smoothing
+        self.image_size = image_size
+        self.bandwidth = None
+        self.rtt = None
+        self.lock = threading.Lock()
+
+    def record(self, n_bytes, n_images, rtt, transfer_time):
+        """
+        Records the measurements of an upload.
+
+        Parameters
+        ----------
+        n_bytes : int
+            Number of bytes sent.
+        n_images : int
+            Number of images in the message.
+        rtt : float
+            Round-trip time in seconds, measured as the duration of the connection handshake.
+        transfer_time : float
+            Duration of sending the message in seconds.
+
+        """
+
+        with self.lock:
+            self.rtt = self.average(self.rtt, rtt)
+            self.bandwidth = self.average(self.bandwidth, n_bytes / max(transfer_time, 1e-6))
+            self.image_size = self.average(self.image_size, n_bytes / n_images)
+
+    def average(self, current, measurement):
+        if current is None:
+            return measurement
+
+        return (1 - self.smoothing) * current + self.smoothing * measurement
+
+    def batch_size(self):
+        """
+        Calculates the number of images to be packed into the next message, so that the round-trip time is at most overhead_ratio
+        of the transfer time of the batch. Before the first measurement, images are sent one by one.
+
+        Returns
+        -------
+        batch_size : int
+            Number of images in the next message, between 1 and max_batch_size.
+
+        """
+
+        with self.lock:
+            if self.rtt is None:
+                return 1
+
+            image_transfer_time = self.image_size / self.bandwidth
+            batch_size = math.ceil(self.rtt / (self.overhead_ratio * image_transfer_time))
+
+        return max(1, min(self.max_batch_size, batch_size))